@@ -0,0 +1,218 @@
+"""
+arena.py
+
+Compact storage for large terms.
+
+pack() flattens a term into an Arena: one array of ints with four per node,
+
+    opcode, a, b, c
+
+where the opcode is the node's tag as an integer (OPCODES), a subterm is the
+index of another node in the same array, and a name or number is an index
+into the arena's constant list. Unused fields are 0. A node takes 16 bytes,
+against 56 to 72 for a tuple. Subterms that are one object in the tuple form
+(see interpreter.mk) are stored once.
+
+Nodes are stored children first, so unpack() rebuilds the tuples in one
+forward pass over the array, with no stack and no recursion, and hands back
+interned nodes. The compiled form of debruijn.py packs as well; nodes()
+rebuilds it without interning. transpile.py stores the terms of a program
+this way instead of as one tuple literal per node (bench_arena.py compares
+the two).
+
+    python3 arena.py "<expr>"      prints the node count and sizes
+"""
+
+import sys
+from array import array
+
+from interpreter import mk
+
+
+# --------------------------------------------------------------------
+# Opcodes
+# --------------------------------------------------------------------
+
+VAR = 0        # a = name
+NUM = 1        # a = value
+FREE = 2       # a = name (compiled form)
+NIL = 3
+BVAR = 4       # a = index, b = name (compiled form)
+LAM = 5        # a = name, b = body
+APP = 6        # a = function, b = argument
+TAPP = 7       # compiled form, as APP
+SAPP = 8
+PLUS = 9
+MINUS = 10
+TIMES = 11
+EQ = 12
+LEQ = 13
+CONS = 14      # a = head, b = tail
+PROG = 15
+NEG = 16       # a = operand
+HD = 17
+TL = 18
+FIX = 19
+IF = 20        # a = condition, b = then, c = else
+LET = 21       # a = name, b = value, c = body
+LETREC = 22    # a = name, b = value, c = body
+
+TAGS = [
+    "var", "num", "free", "nil", "bvar", "lam", "app", "tapp", "sapp",
+    "plus", "minus", "times", "eq", "leq", "cons", "prog",
+    "neg", "hd", "tl", "fix", "if", "let", "letrec",
+]
+
+OPCODES = {tag: op for op, tag in enumerate(TAGS)}
+
+# fields of each opcode that hold a constant; the others hold subterms
+_CONST_FIELDS = {VAR: 1, NUM: 1, FREE: 1, BVAR: 2, LAM: 1, LET: 1, LETREC: 1}
+
+WIDTH = 4
+
+
+class Arena:
+    __slots__ = ("code", "consts", "root")
+
+    def __init__(self, code=None, consts=None, root=-1):
+        self.code = array("i") if code is None else code
+        self.consts = [] if consts is None else consts
+        self.root = root
+
+    def __len__(self):
+        return len(self.code) // WIDTH
+
+    def nbytes(self):
+        return self.code.itemsize * len(self.code)
+
+    def op(self, i):
+        return self.code[i * WIDTH]
+
+    def tag(self, i):
+        return TAGS[self.code[i * WIDTH]]
+
+
+# --------------------------------------------------------------------
+# Packing and unpacking
+# --------------------------------------------------------------------
+
+def _const_key(x):
+    # keep 0.0 and -0.0 apart
+    return (float, repr(x)) if type(x) is float else (type(x), x)
+
+
+def pack(t, index=None):
+    """
+    Term -> Arena. index, if given, is filled with id(node) -> the node's
+    position for every node of t.
+    """
+    arena = Arena()
+    code = arena.code
+    consts = arena.consts
+    const_index = {}
+    # id(node) -> node index; t keeps every node alive while this runs
+    if index is None:
+        index = {}
+
+    work = [t]
+    while work:
+        node = work[-1]
+        if id(node) in index:
+            work.pop()
+            continue
+        op = OPCODES[node[0]]
+        nconst = _CONST_FIELDS.get(op, 0)
+        pending = False
+        for k in node[1 + nconst:]:
+            if id(k) not in index:
+                work.append(k)
+                pending = True
+        if pending:
+            continue
+
+        work.pop()
+        row = [op, 0, 0, 0]
+        i = 1
+        for x in node[1:]:
+            if i <= nconst:
+                key = _const_key(x)
+                k = const_index.get(key)
+                if k is None:
+                    k = const_index[key] = len(consts)
+                    consts.append(x)
+                row[i] = k
+            else:
+                row[i] = index[id(x)]
+            i += 1
+        index[id(node)] = len(code) // WIDTH
+        code.extend(row)
+
+    arena.root = index[id(t)]
+    return arena
+
+
+def nodes(arena, make=mk):
+    """Every node of arena as a term, in order, built with make(*node)"""
+    code = arena.code
+    consts = arena.consts
+    out = []
+
+    for i in range(0, len(code), WIDTH):
+        op = code[i]
+        tag = TAGS[op]
+        if op <= FREE:
+            node = make(tag, consts[code[i + 1]])
+        elif op == NIL:
+            node = make(tag)
+        elif op == BVAR:
+            node = make(tag, consts[code[i + 1]], consts[code[i + 2]])
+        elif op == LAM:
+            node = make(tag, consts[code[i + 1]], out[code[i + 2]])
+        elif op <= PROG:
+            node = make(tag, out[code[i + 1]], out[code[i + 2]])
+        elif op <= FIX:
+            node = make(tag, out[code[i + 1]])
+        elif op == IF:
+            node = make(tag, out[code[i + 1]], out[code[i + 2]], out[code[i + 3]])
+        else:
+            node = make(tag, consts[code[i + 1]], out[code[i + 2]], out[code[i + 3]])
+        out.append(node)
+
+    return out
+
+
+def unpack(arena):
+    """Arena -> the tuple AST it was packed from"""
+    return nodes(arena)[arena.root]
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: arena.py "<expr>"')
+        sys.exit(1)
+
+    from interpreter import get_parser, LambdaCalculusTransformer
+
+    t = LambdaCalculusTransformer().transform(get_parser().parse(sys.argv[1]))
+    arena = pack(t)
+    tuples = sum(sys.getsizeof(node) for node in _unique(t))
+    print(f"nodes:  {len(arena)}")
+    print(f"packed: {arena.nbytes()} bytes + {len(arena.consts)} constants")
+    print(f"tuples: {tuples} bytes")
+
+
+def _unique(t):
+    """The distinct node objects of t"""
+    seen = {}
+    work = [t]
+    while work:
+        node = work.pop()
+        if id(node) in seen:
+            continue
+        seen[id(node)] = node
+        work += [x for x in node[1:] if type(x) is tuple]
+    return seen.values()
+
+
+if __name__ == "__main__":
+    main()
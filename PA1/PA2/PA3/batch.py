@@ -0,0 +1,121 @@
+"""
+batch.py
+
+Runs many programs at once on a pool of worker processes.
+
+interpret_many() fans the programs out to a ProcessPoolExecutor in chunks
+and returns one Outcome per program, in input order. Each worker builds the
+parser once, when it starts. A program that fails to parse, or that breaks
+the interpreter in some other way, gives an Outcome with status ERROR
+instead of raising, so one bad program does not cost the rest of the batch.
+That holds for a program that kills its worker process too: the pool is
+started again for the programs it took down with it.
+
+    python3 interpreter.py --batch programs.txt --workers 8
+"""
+
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import interpreter
+from interpreter import MAX_STEPS, get_parser, interpret
+
+
+OK = "ok"
+NON_TERMINATING = "non-terminating"
+ERROR = "error"
+
+# status is OK, NON_TERMINATING or ERROR; output is what interpret() prints
+# (None on ERROR); error describes the failure
+Outcome = collections.namedtuple("Outcome", "status output error")
+
+# programs per task handed to a worker, per worker: enough to keep the
+# inter-process traffic small, few enough to balance the load
+CHUNKS_PER_WORKER = 4
+
+
+def run_one(src, backend="rewrite", passes=None, max_steps=MAX_STEPS):
+    """interpret() one program, as an Outcome"""
+    try:
+        out = interpret(src, backend=backend, passes=passes, max_steps=max_steps)
+    except Exception as e:
+        return Outcome(ERROR, None, f"{type(e).__name__}: {e}")
+    if out == interpreter.NON_TERMINATING:
+        return Outcome(NON_TERMINATING, out, None)
+    return Outcome(OK, out, None)
+
+
+def _run_job(job):
+    return run_one(*job)
+
+
+def _run_chunk(jobs):
+    return [run_one(*job) for job in jobs]
+
+
+def _died(e):
+    return Outcome(ERROR, None, f"worker died: {type(e).__name__}")
+
+
+def _run_alone(jobs, outcomes, indices):
+    """
+    Run jobs[i] for i in indices one at a time on a single worker, started
+    again whenever one dies, so a program that kills its worker is the one
+    that gets the ERROR.
+    """
+    pool = None
+    try:
+        for i in indices:
+            if pool is None:
+                pool = ProcessPoolExecutor(max_workers=1, initializer=get_parser)
+            try:
+                outcomes[i] = pool.submit(_run_job, jobs[i]).result()
+            except BrokenProcessPool as e:
+                outcomes[i] = _died(e)
+                pool.shutdown()
+                pool = None
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def interpret_many(sources, workers=None, chunksize=None, backend="rewrite",
+                   passes=None, max_steps=MAX_STEPS):
+    """
+    Outcomes of running every program in sources, in order. workers
+    defaults to one per CPU; with workers=1 everything runs in this process.
+    If a worker dies, the programs whose chunks were lost with the pool are
+    run again one at a time, and only a program that kills its worker
+    again gets an ERROR outcome.
+    """
+    sources = list(sources)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(sources)))
+    jobs = [(src, backend, passes, max_steps) for src in sources]
+
+    if workers == 1:
+        return [_run_job(job) for job in jobs]
+
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * CHUNKS_PER_WORKER))
+    outcomes = [None] * len(jobs)
+    lost = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=get_parser) as pool:
+        chunks = {
+            pool.submit(_run_chunk, jobs[i:i + chunksize]): i
+            for i in range(0, len(jobs), chunksize)
+        }
+        for future, i in chunks.items():
+            n = min(chunksize, len(jobs) - i)
+            try:
+                outcomes[i:i + n] = future.result()
+            except BrokenProcessPool:
+                # the pool is gone: this chunk may never have started
+                lost += range(i, i + n)
+            except Exception as e:
+                outcomes[i:i + n] = [Outcome(ERROR, None, f"{type(e).__name__}: {e}")] * n
+    _run_alone(jobs, outcomes, lost)
+    return outcomes
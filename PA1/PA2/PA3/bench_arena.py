@@ -0,0 +1,71 @@
+"""
+bench_arena.py
+
+Benchmark of the two forms transpile.py can emit the terms of a program in:
+packed (arena.py, the default) and as tuple literals, one assignment per
+node (transpile(t, packed=False)).
+
+For generated programs of growing size it prints the milliseconds taken to
+transpile and to compile the source (what a run without a cached code
+object pays on top of evaluating), the size of the marshalled code object
+(what the on-disk cache stores), and the milliseconds taken to load and run
+the module body (what every run pays).
+
+    python3 bench_arena.py [sizes...]
+"""
+
+import marshal
+import sys
+import time
+
+import arena
+import transpile
+from interpreter import get_parser, LambdaCalculusTransformer
+
+
+def program(n):
+    """A recursive function whose body is a sum of n small products"""
+    def balanced(items):
+        if len(items) == 1:
+            return items[0]
+        mid = len(items) // 2
+        return f"({balanced(items[:mid])} + {balanced(items[mid:])})"
+
+    body = balanced([f"(n * {i} - 1)" for i in range(n)])
+    return rf"letrec f = \n. if n == 0 then 0 else {body} + f (n - 1) in f 3"
+
+
+def measure(t, packed):
+    start = time.perf_counter()
+    src = transpile.transpile(t, packed)
+    transpiled = time.perf_counter()
+    code = compile(src, "<pa3>", "exec")
+    compiled = time.perf_counter()
+    blob = marshal.dumps(code)
+
+    start_load = time.perf_counter()
+    exec(marshal.loads(blob), dict(transpile.RUNTIME))
+    loaded = time.perf_counter()
+    return (
+        (transpiled - start) * 1000,
+        (compiled - transpiled) * 1000,
+        len(blob) / 1024,
+        (loaded - start_load) * 1000,
+    )
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [500, 2000, 8000]
+    columns = ("transpile ms", "compile ms", "marshal KiB", "load ms")
+    print(f"{'nodes':>8} {'form':8}" + "".join(f"{c:>14}" for c in columns))
+    for n in sizes:
+        t = LambdaCalculusTransformer().transform(get_parser().parse(program(n)))
+        nodes = len(arena.pack(t))
+        for form, packed in (("literal", False), ("packed", True)):
+            runs = [measure(t, packed) for _ in range(3)]
+            best = [min(column) for column in zip(*runs)]
+            print(f"{nodes:8} {form:8}" + "".join(f"{x:14.1f}" for x in best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+bench_dispatch.py
+
+Microbenchmark for the per-node dispatch in interpreter.py.
+
+Each tag gets a small node that is stuck on a free variable, so the rule
+found for it does almost no work and the time measured is mostly the cost of
+getting there. Prints nanoseconds per call of step, substitute, free_vars and
+linearize for every tag, and the time linearize takes over a whole program.
+
+With --baseline, another copy of interpreter.py (say, one saved with git
+show) is timed the same way and each column is printed for both, baseline
+first, so a change can be kept only if it measures faster. The baseline is
+imported on its own and may read grammar.lark from the current directory.
+
+    python3 bench_dispatch.py [--baseline FILE] [repeat]
+"""
+
+import argparse
+import importlib.util
+import timeit
+
+import interpreter
+
+
+def nodes(mod):
+    """A stuck node per tag, built with mod's constructor"""
+    mk = mod.mk
+    X = mk("var", "x")
+    Y = mk("var", "y")
+    return {
+        "var": X,
+        "num": mk("num", 1.0),
+        "nil": mk("nil"),
+        "lam": mk("lam", "z", X),
+        "app": mk("app", X, Y),
+        "plus": mk("plus", X, Y),
+        "minus": mk("minus", X, Y),
+        "times": mk("times", X, Y),
+        "eq": mk("eq", X, Y),
+        "leq": mk("leq", X, Y),
+        "cons": mk("cons", X, Y),
+        "prog": mk("prog", X, Y),
+        "neg": mk("neg", X),
+        "hd": mk("hd", X),
+        "tl": mk("tl", X),
+        "fix": mk("fix", X),
+        "if": mk("if", X, Y, Y),
+        "let": mk("let", "z", X, Y),
+        "letrec": mk("letrec", "z", X, Y),
+    }
+
+
+# a term with some of every printed construct, printed as parsed
+PROGRAM = " : ".join(
+    rf"(\x. if x <= {i} then hd (f x) else let y = -x in y * {i} - tl x) ({i} + a)"
+    for i in range(100)
+) + " : #"
+
+
+def benches(mod):
+    Y = mod.mk("var", "y")
+
+    def free_vars_uncached(t):
+        mod._fv_cache.clear()
+        return mod.free_vars(t)
+
+    return {
+        "step": lambda t: mod.step(t),
+        "substitute": lambda t: mod.substitute(t, "x", Y),
+        "free_vars": free_vars_uncached,
+        "linearize": mod.linearize,
+    }
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location("baseline_interpreter", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def time_ns(fn, arg, repeat):
+    best = min(timeit.repeat(lambda: fn(arg), number=repeat, repeat=5))
+    return best / repeat * 1e9
+
+
+def main():
+    ap = argparse.ArgumentParser(description="per-node dispatch costs")
+    ap.add_argument("repeat", nargs="?", type=int, default=20000)
+    ap.add_argument("--baseline", metavar="FILE", help="an interpreter.py to compare with")
+    args = ap.parse_args()
+
+    mods = {"current": interpreter}
+    if args.baseline:
+        mods = {"baseline": load(args.baseline), "current": interpreter}
+    tables = {label: (nodes(mod), benches(mod)) for label, mod in mods.items()}
+    names = list(benches(interpreter))
+    tags = list(nodes(interpreter))
+
+    columns = [name if len(mods) == 1 else f"{name} {label[0]}"
+               for name in names for label in mods]
+    print(f"{'tag':8}" + "".join(f"{c:>14}" for c in columns))
+    totals = [0.0] * len(columns)
+    for tag in tags:
+        row = [time_ns(fns[name], cases[tag], args.repeat)
+               for name in names for cases, fns in tables.values()]
+        totals = [a + b for a, b in zip(totals, row)]
+        print(f"{tag:8}" + "".join(f"{ns:14.0f}" for ns in row))
+    print(f"{'mean':8}" + "".join(f"{ns / len(tags):14.0f}" for ns in totals))
+    print("ns per call" + (" (b = baseline, c = current)" if len(mods) > 1 else ""))
+
+    print()
+    for label, mod in mods.items():
+        t = mod.LambdaCalculusTransformer().transform(interpreter.get_parser().parse(PROGRAM))
+        us = time_ns(mod.linearize, t, max(1, args.repeat // 100)) / 1000
+        print(f"linearize of a {len(PROGRAM)}-character program, {label}: {us:.0f} us")
+
+if __name__ == "__main__":
+    main()
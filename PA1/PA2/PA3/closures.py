@@ -0,0 +1,324 @@
+"""
+closures.py
+
+Closure-compilation backend for the PA3 language.
+
+The de Bruijn form from debruijn.py is walked once and every node becomes a
+Python function of the environment: plus becomes roughly
+
+    lambda env: l(env) + r(env)
+
+and running the program is one call to the root function. No tag is looked
+at after compilation, so arithmetic-heavy letrec code runs far faster than
+under step(). Evaluation is call-by-name with the runtime values,
+environments and read back of machine.py, so results print exactly as with
+the other backends.
+
+A call in tail position of a lambda body (see debruijn.mark_tail_calls)
+does not call the function: it returns a TailCall, and the trampoline in
+apply() that made the enclosing call runs it in a loop, so a tail-recursive
+letrec loop runs in constant Python stack. Every other call nests, so
+evaluation depth is Python stack depth. The recursion limit is the
+process's own and is left alone: a term too deep for it raises
+RecursionError and is run again on the CEK machine, which has no depth
+limit.
+"""
+
+from interpreter import MAX_STEPS
+from debruijn import compile_term, mark_tail_calls, cheap
+import machine
+from machine import (
+    NIL, Cons, Closure, Neutral, Thunk, RecThunk, reify, close_term, values_equal,
+    speculate, evaluated, Speculated,
+)
+
+
+class CClosure(Closure):
+    __slots__ = ("code",)
+
+    def __init__(self, term, env, code):
+        self.term = term
+        self.env = env
+        self.code = code
+
+
+class CThunk(Thunk):
+    __slots__ = ("code",)
+
+    def __init__(self, term, env, code):
+        self.term = term
+        self.env = env
+        self.value = None
+        self.code = code
+
+
+class CRecThunk(CThunk, RecThunk):
+    __slots__ = ()
+
+
+def force(th):
+    v = th.value
+    if v is not None:
+        return v
+    return th.code(th.env)
+
+
+class TailCall:
+    __slots__ = ("fn", "arg")
+
+    def __init__(self, fn, arg):
+        self.fn = fn
+        self.arg = arg
+
+
+# calls left before the program counts as non-terminating; set by evaluate
+fuel = [MAX_STEPS]
+
+
+def apply(f, th):
+    """Call f with argument thunk th, running any tail calls it returns"""
+    while isinstance(f, Closure):
+        fuel[0] -= 1
+        if fuel[0] < 0:
+            raise RuntimeError("non-terminating")
+        r = f.code((f.term[1], th, f.env))
+        if type(r) is not TailCall:
+            return r
+        f, th = r.fn, r.arg
+    return Neutral(("app", reify(f), reify(force(th))))
+
+
+def tail_call(f, th):
+    """A call in tail position: leave it to the enclosing apply()"""
+    if isinstance(f, Closure):
+        return TailCall(f, th)
+    return Neutral(("app", reify(f), reify(force(th))))
+
+
+def unfold(f):
+    """fix F  -->  F (fix F)"""
+    if not isinstance(f, Closure):
+        return Neutral(("fix", reify(f)))
+    lam, body = f.term, f.code
+    again = CRecThunk(("fix", lam), f.env, lambda env: unfold(CClosure(lam, env, body)))
+    fuel[0] -= 1
+    if fuel[0] < 0:
+        raise RuntimeError("non-terminating")
+    r = body((lam[1], again, f.env))
+    if type(r) is TailCall:
+        r = apply(r.fn, r.arg)
+    if isinstance(r, Closure):
+        # F returned a lambda: that is fix F, so tie the knot
+        again.value = r
+    return r
+
+
+def letrec(name, fixed, code, env, closure):
+    """
+    Environment for the body of letrec name = ...; fixed is the compiled
+    fix term and code evaluates it. closure, if given, makes the bound
+    lambda's closure in the new environment, tying the knot.
+    """
+    th = CRecThunk(fixed, env, code)
+    env = (name, th, env)
+    if closure is not None:
+        th.value = closure(env)
+    return env
+
+
+# --------------------------------------------------------------------
+# Compiler
+# --------------------------------------------------------------------
+
+def compile_node(c):
+    """Compiled de Bruijn node -> function of the environment"""
+    tag = c[0]
+
+    if tag == "num":
+        n = c[1]
+        return lambda env: n
+
+    if tag == "bvar":
+        k = c[1]
+        if k == 0:
+            def var(env):
+                th = env[1]
+                v = th.value
+                return v if v is not None else th.code(th.env)
+        elif k == 1:
+            def var(env):
+                th = env[2][1]
+                v = th.value
+                return v if v is not None else th.code(th.env)
+        else:
+            def var(env):
+                for _ in range(k):
+                    env = env[2]
+                return force(env[1])
+        return var
+
+    if tag == "lam":
+        body = compile_node(c[2])
+        return lambda env: CClosure(c, env, body)
+
+    if tag in ("app", "sapp"):
+        fn = compile_node(c[1])
+        arg = compile_arg(c[2], tag == "sapp")
+        return lambda env: apply(fn(env), arg(env))
+
+    if tag == "tapp":
+        fn = compile_node(c[1])
+        arg = compile_arg(c[2], True)
+        return lambda env: tail_call(fn(env), arg(env))
+
+    if tag in ("plus", "minus", "times", "leq"):
+        left = compile_node(c[1])
+        right = compile_node(c[2])
+
+        def stuck(l, r):
+            return Neutral((tag, reify(l), reify(r)))
+
+        if tag == "plus":
+            def binop(env):
+                l, r = left(env), right(env)
+                if type(l) is float and type(r) is float:
+                    return l + r
+                return stuck(l, r)
+        elif tag == "minus":
+            def binop(env):
+                l, r = left(env), right(env)
+                if type(l) is float and type(r) is float:
+                    return l - r
+                return stuck(l, r)
+        elif tag == "times":
+            def binop(env):
+                l, r = left(env), right(env)
+                if type(l) is float and type(r) is float:
+                    return l * r
+                return stuck(l, r)
+        else:
+            def binop(env):
+                l, r = left(env), right(env)
+                if type(l) is float and type(r) is float:
+                    return 1.0 if l <= r else 0.0
+                return stuck(l, r)
+        return binop
+
+    if tag == "eq":
+        left = compile_node(c[1])
+        right = compile_node(c[2])
+        return lambda env: 1.0 if values_equal(left(env), right(env)) else 0.0
+
+    if tag == "if":
+        cond = compile_node(c[1])
+        then = compile_node(c[2])
+        other = compile_node(c[3])
+
+        def branch(env):
+            v = cond(env)
+            if type(v) is float:
+                if v == 1.0:
+                    return then(env)
+                if v == 0.0:
+                    return other(env)
+            return Neutral(("if", reify(v), close_term(c[2], env), close_term(c[3], env)))
+        return branch
+
+    if tag == "let":
+        # let x = e1 in e2  -->  (\x.e2) e1
+        name = c[1]
+        value = compile_arg(c[2])
+        body = compile_node(c[3])
+        return lambda env: body((name, value(env), env))
+
+    if tag == "letrec":
+        # letrec f = e1 in e2  -->  let f = (fix (\f.e1)) in e2
+        name, fixed = c[1], c[2]
+        fix = compile_node(fixed)
+        body = compile_node(c[3])
+        value = fixed[1][2]
+        closure = compile_node(value) if value[0] == "lam" else None
+        return lambda env: body(letrec(name, fixed, fix, env, closure))
+
+    if tag == "fix":
+        fn = compile_node(c[1])
+        return lambda env: unfold(fn(env))
+
+    if tag == "neg":
+        x = compile_node(c[1])
+
+        def neg(env):
+            v = x(env)
+            return -v if type(v) is float else Neutral(("neg", reify(v)))
+        return neg
+
+    if tag in ("hd", "tl"):
+        x = compile_node(c[1])
+        head = tag == "hd"
+
+        def destruct(env):
+            v = x(env)
+            if isinstance(v, Cons):
+                return v.head if head else v.tail
+            return Neutral((tag, reify(v)))
+        return destruct
+
+    if tag == "cons":
+        h = compile_node(c[1])
+        t = compile_node(c[2])
+        return lambda env: Cons(h(env), t(env))
+
+    if tag == "nil":
+        return lambda env: NIL
+
+    if tag == "prog":
+        left = compile_node(c[1])
+        right = compile_node(c[2])
+        return lambda env: Neutral(("prog", reify(left(env)), reify(right(env))))
+
+    if tag == "free":
+        v = Neutral(("var", c[1]))
+        return lambda env: v
+
+    raise ValueError(f"cannot compile node: {tag}")
+
+
+def compile_arg(c, spec=False):
+    """
+    Compiled argument -> function of the environment returning a thunk.
+    With spec (calls inside lambda bodies), cheap arithmetic is speculated.
+    """
+    if c[0] == "bvar":
+        # pass the variable's own thunk along
+        k = c[1]
+
+        def share(env):
+            for _ in range(k):
+                env = env[2]
+            return env[1]
+        return share
+
+    if c[0] == "num":
+        # nothing to delay, even by name
+        th = CThunk(c, None, None)
+        th.value = c[1]
+        return lambda env: th
+
+    code = compile_node(c)
+    if spec and cheap(c):
+        def speculated(env):
+            n = speculate(c, env)
+            return CThunk(c, env, code) if n is None else Speculated(c, env, n)
+        return speculated
+    return lambda env: CThunk(c, env, code)
+
+
+def evaluate(t, max_steps=MAX_STEPS):
+    """Drop-in replacement for interpreter.evaluate"""
+    c = mark_tail_calls(compile_term(t))
+    fuel[0] = max_steps
+    try:
+        return reify(compile_node(c)(None))
+    except RecursionError:
+        pass
+    return reify(machine.run(c, max_steps=max_steps))
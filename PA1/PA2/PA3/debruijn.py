@@ -0,0 +1,247 @@
+"""
+debruijn.py
+
+Compile stage from the tuple AST to a de Bruijn-indexed form.
+
+Bound variables become ("bvar", k, name), where k counts the binders between
+the occurrence and its own binder (0 = innermost). Variables with no binder
+become ("free", name). Binders keep their source name only as a hint for
+printing, so evaluating the compiled form never needs free_vars, fresh names
+or capture-avoiding renaming; names come back in decompile().
+
+    ("lam", name, body)                     body under one more binder
+    ("let", name, value, body)              body under one more binder
+    ("letrec", name, fixed, body)           fixed is ("fix", ("lam", name, value))
+                                            and body is under one more binder
+
+Every other node keeps the tag and shape of the tuple AST.
+
+mark_tail_calls() retags the applications inside lambda bodies, for the
+backends that run tail calls in constant stack: ("tapp", f, a) in tail
+position and ("sapp", f, a) elsewhere. Both mark calls that may pass a
+cheap arithmetic argument as a number (see machine.speculate).
+
+Like the traversals in interpreter.py, these use an explicit stack so that
+very deep terms do not hit the recursion limit.
+"""
+
+# work list instructions
+_ENTER, _EXIT, _BIND, _UNBIND = range(4)
+
+
+def compile_term(t, scope=()):
+    """Compile a tuple AST; scope lists the enclosing binder names, innermost last"""
+    scope = list(scope)
+    out = []
+    work = [(_ENTER, t)]
+
+    while work:
+        op, node = work.pop()
+
+        if op == _BIND:
+            scope.append(node)
+            continue
+        if op == _UNBIND:
+            scope.pop()
+            continue
+
+        tag = node[0]
+
+        if op == _EXIT:
+            # the compiled children are on top of out, in order
+            if tag == "lam":
+                body = out.pop()
+                out.append(("lam", node[1], body))
+            elif tag == "let":
+                body = out.pop()
+                value = out.pop()
+                out.append(("let", node[1], value, body))
+            elif tag == "letrec":
+                body = out.pop()
+                value = out.pop()
+                out.append(("letrec", node[1], ("fix", ("lam", node[1], value)), body))
+            else:
+                n = len(node) - 1
+                kids = tuple(out[-n:])
+                del out[-n:]
+                out.append((tag,) + kids)
+            continue
+
+        if tag == "var":
+            name = node[1]
+            for k in range(len(scope)):
+                if scope[-1 - k] == name:
+                    out.append(("bvar", k, name))
+                    break
+            else:
+                out.append(("free", name))
+
+        elif tag in ("num", "nil"):
+            out.append(node)
+
+        # push in reverse: the last instruction pushed runs first
+        elif tag == "lam":
+            work += [(_EXIT, node), (_UNBIND, None), (_ENTER, node[2]), (_BIND, node[1])]
+
+        elif tag == "let":
+            work += [(_EXIT, node), (_UNBIND, None), (_ENTER, node[3]),
+                     (_BIND, node[1]), (_ENTER, node[2])]
+
+        elif tag == "letrec":
+            work += [(_EXIT, node), (_UNBIND, None), (_ENTER, node[3]),
+                     (_ENTER, node[2]), (_BIND, node[1])]
+
+        else:
+            work.append((_EXIT, node))
+            work += [(_ENTER, c) for c in reversed(node[1:])]
+
+    return out[0]
+
+
+def decompile(c):
+    """Back to the named tuple AST, using the binder hints"""
+    out = []
+    work = [(_ENTER, c)]
+
+    while work:
+        op, node = work.pop()
+        tag = node[0]
+
+        if op == _EXIT:
+            if tag in ("lam", "let", "letrec"):
+                n = 1 if tag == "lam" else 2
+                kids = tuple(out[-n:])
+                del out[-n:]
+                out.append((tag, node[1]) + kids)
+            else:
+                n = len(node) - 1
+                kids = tuple(out[-n:])
+                del out[-n:]
+                out.append((tag,) + kids)
+
+        elif tag == "bvar":
+            out.append(("var", node[2]))
+
+        elif tag in ("tapp", "sapp"):
+            work += [(_EXIT, ("app",) + node[1:]), (_ENTER, node[2]), (_ENTER, node[1])]
+
+        elif tag == "free":
+            out.append(("var", node[1]))
+
+        elif tag in ("num", "nil"):
+            out.append(node)
+
+        elif tag == "lam":
+            work += [(_EXIT, node), (_ENTER, node[2])]
+
+        elif tag == "let":
+            work += [(_EXIT, node), (_ENTER, node[3]), (_ENTER, node[2])]
+
+        elif tag == "letrec":
+            # ("fix", ("lam", name, value)) goes back to plain value
+            work += [(_EXIT, node), (_ENTER, node[3]), (_ENTER, node[2][1][2])]
+
+        else:
+            work.append((_EXIT, node))
+            work += [(_ENTER, x) for x in reversed(node[1:])]
+
+    return out[0]
+
+
+def env_refs(c, depth=0):
+    """Indices into the enclosing environment that c refers to"""
+    out = set()
+    work = [(c, depth)]
+
+    while work:
+        c, depth = work.pop()
+        tag = c[0]
+
+        if tag == "bvar":
+            if c[1] >= depth:
+                out.add(c[1] - depth)
+        elif tag == "lam":
+            work.append((c[2], depth + 1))
+        elif tag in ("let", "letrec"):
+            work.append((c[2], depth))
+            work.append((c[3], depth + 1))
+        elif tag not in ("free", "num", "nil"):
+            work += [(x, depth) for x in c[1:]]
+
+    return out
+
+
+# arithmetic arguments up to this many nodes are cheap enough to evaluate
+# ahead of a tail call
+CHEAP_SIZE = 16
+
+
+def cheap(c):
+    """Arithmetic over numbers and variables, small, and not already atomic"""
+    if c[0] not in ("plus", "minus", "times", "neg"):
+        return False
+    n = 0
+    work = [c]
+    while work:
+        c = work.pop()
+        n += 1
+        if n > CHEAP_SIZE:
+            return False
+        if c[0] in ("plus", "minus", "times", "neg"):
+            work += c[1:]
+        elif c[0] not in ("num", "bvar"):
+            return False
+    return True
+
+
+# position of a node for mark_tail_calls: outside every lambda, inside one,
+# or in tail position of one
+_TOP, _INNER, _TAIL = range(3)
+
+
+def mark_tail_calls(c):
+    """Retag calls in lambda bodies: tapp in tail position, sapp elsewhere"""
+    out = []
+    work = [(_ENTER, c, _TOP)]
+
+    while work:
+        op, node, pos = work.pop()
+        tag = node[0]
+
+        if op == _EXIT:
+            n = len(node) - 1
+            if tag in ("lam", "let", "letrec"):
+                n -= 1
+            kids = tuple(out[-n:])
+            del out[-n:]
+            if tag in ("lam", "let", "letrec"):
+                out.append((tag, node[1]) + kids)
+            elif tag == "app" and pos == _TAIL:
+                out.append(("tapp",) + kids)
+            elif tag == "app" and pos == _INNER:
+                out.append(("sapp",) + kids)
+            else:
+                out.append((tag,) + kids)
+            continue
+
+        # subterms that are not in tail position
+        inner = _TOP if pos == _TOP else _INNER
+
+        if tag in ("bvar", "free", "num", "nil"):
+            out.append(node)
+
+        elif tag == "lam":
+            work += [(_EXIT, node, pos), (_ENTER, node[2], _TAIL)]
+
+        elif tag in ("let", "letrec"):
+            work += [(_EXIT, node, pos), (_ENTER, node[3], pos), (_ENTER, node[2], inner)]
+
+        elif tag == "if":
+            work += [(_EXIT, node, pos), (_ENTER, node[3], pos),
+                     (_ENTER, node[2], pos), (_ENTER, node[1], inner)]
+
+        else:
+            work.append((_EXIT, node, pos))
+            work += [(_ENTER, x, inner) for x in reversed(node[1:])]
+
+    return out[0]
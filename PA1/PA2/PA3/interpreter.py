@@ -1,241 +1,464 @@
 import sys
+import math
+import collections
+import operator
 import os
-from lark import Lark, Transformer
+import argparse
+import importlib
+import threading
+import time
+from lark import Lark, Transformer_NonRecursive
+
+import streaming
+from streaming import records
 
 # Parser
 
-parser = Lark(open("grammar.lark").read(), parser="lalr")
+# found next to this module, whatever the current directory
+GRAMMAR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grammar.lark")
+
+# on-disk caches (compiled programs, results) go here
+CACHE_DIR = os.environ.get(
+    "PA3_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pa3")
+)
+
+_parser = None
+
+
+def get_parser():
+    """
+    The LALR parser, built on first use. lark keeps its tables in a cache
+    file keyed by a hash of the grammar, so only the first run after the
+    grammar changes pays for building them.
+    """
+    global _parser, parser
+    if _parser is None:
+        with open(GRAMMAR_PATH) as f:
+            _parser = Lark(f.read(), parser="lalr", cache=True)
+        parser = _parser
+    return _parser
+
+
+def __getattr__(name):
+    # `interpreter.parser` / `from interpreter import parser` build it lazily
+    if name == "parser":
+        return get_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --------------------------------------------------------------------
+# Hash-consing
+# --------------------------------------------------------------------
+
+# Every node is built by mk(), which hands back the existing node when an
+# equal one was built before, so equal terms are one object. A node's
+# children are interned already, so it is looked up by its children's ids;
+# the table keeps them alive, and an id cannot be reused while its entry
+# exists. Numbers are keyed with their sign as well, so 0.0 and -0.0 stay
+# apart. The table is bounded like the free-variable cache: when it is
+# cleared, equal nodes built afterwards are merely no longer shared.
+_interned = {}
+INTERN_LIMIT = 1 << 16
+
+# ids of the interned nodes that are closed data (numbers other than NaN,
+# nil, and cons cells of those): for these, being the same object means
+# being equal under ==
+_literals = set()
+
+
+def _intern(key, node):
+    if len(_interned) >= INTERN_LIMIT:
+        _interned.clear()
+        _literals.clear()
+    _interned[key] = node
+    tag = node[0]
+    if (tag == "nil" or (tag == "num" and node[1] == node[1])
+            or (tag == "cons" and id(node[1]) in _literals and id(node[2]) in _literals)):
+        _literals.add(id(node))
+    return node
+
+
+def mk(*node):
+    """The interned node equal to node"""
+    if node[0] == "num":
+        key = ("num", node[1], math.copysign(1.0, node[1]))
+    elif len(node) == 3:
+        # lam, app, arithmetic, comparisons, prog, cons
+        a = node[1]
+        key = (node[0], a if type(a) is str else id(a), id(node[2]))
+    elif len(node) == 2:
+        # var, neg, hd, tl, fix
+        a = node[1]
+        key = (node[0], a if type(a) is str else id(a))
+    elif len(node) == 4:
+        # if, let, letrec
+        a = node[1]
+        key = (node[0], a if type(a) is str else id(a), id(node[2]), id(node[3]))
+    elif len(node) == 5:
+        # packed list (see _cons): the buffer is part of the key by identity
+        key = (node[0], id(node[1]), id(node[2]), node[3], node[4])
+    else:
+        # nil
+        key = node
+    hit = _interned.get(key)
+    return _intern(key, node) if hit is None else hit
+
+
+def _mk2(tag, a, b):
+    """mk(tag, a, b) for a node with two subterms, on the hot paths"""
+    key = (tag, id(a), id(b))
+    hit = _interned.get(key)
+    return _intern(key, (tag, a, b)) if hit is None else hit
 
 
-class LambdaCalculusTransformer(Transformer):
+class LambdaCalculusTransformer(Transformer_NonRecursive):
     def start(self, args):
         return args[0]
 
     def var(self, args):
-        return ("var", str(args[0]))
+        return mk("var", str(args[0]))
 
     def lam(self, args):
-        return ("lam", str(args[0]), args[1])
+        return mk("lam", str(args[0]), args[1])
 
     def app(self, args):
-        return ("app", args[0], args[1])
+        return mk("app", args[0], args[1])
 
     def num(self, args):
-        return ("num", float(str(args[0])))
+        return mk("num", float(str(args[0])))
 
     def plus(self, args):
-        return ("plus", args[0], args[1])
+        return mk("plus", args[0], args[1])
 
     def minus(self, args):
-        return ("minus", args[0], args[1])
+        return mk("minus", args[0], args[1])
 
     def times(self, args):
-        return ("times", args[0], args[1])
+        return mk("times", args[0], args[1])
 
     def neg(self, args):
-        return ("neg", args[0])
+        return mk("neg", args[0])
 
     def ifexpr(self, args):
-        return ("if", args[0], args[1], args[2])
+        return mk("if", args[0], args[1], args[2])
 
     def eq(self, args):
-        return ("eq", args[0], args[1])
+        return mk("eq", args[0], args[1])
 
     def leq(self, args):
-        return ("leq", args[0], args[1])
+        return mk("leq", args[0], args[1])
 
     def let(self, args):
-        return ("let", str(args[0]), args[1], args[2])
+        return mk("let", str(args[0]), args[1], args[2])
 
     def letrec(self, args):
-        return ("letrec", str(args[0]), args[1], args[2])
+        return mk("letrec", str(args[0]), args[1], args[2])
 
     def fix(self, args):
-        return ("fix", args[0])
+        return mk("fix", args[0])
 
     def prog(self, args):
-        return ("prog", args[0], args[1])
+        return mk("prog", args[0], args[1])
 
     def nil(self, args):
-        return ("nil",)
+        return mk("nil")
 
     def cons(self, args):
-        return ("cons", args[0], args[1])
+        return mk("cons", args[0], args[1])
 
     def hd(self, args):
-        return ("hd", args[0])
+        return mk("hd", args[0])
 
     def tl(self, args):
-        return ("tl", args[0])
+        return mk("tl", args[0])
 
 
 # --------------------------------------------------------------------
-# Pretty printer
+# Handler tables
 # --------------------------------------------------------------------
 
-def linearize(t, top=True):
-    tag = t[0]
+# The traversals below (printing, free variables, substitution, stepping)
+# look their rule for a node up in a dict keyed by tag, so finding it costs
+# the same for every tag. A new construct is added by registering its
+# handlers, e.g.
+#
+#     @handles(STEP_AFTER, "mod")
+#     def _step_mod(t, stats):
+#         ...
+
+def handles(table, *tags):
+    """Decorator: register the function in table under each of tags"""
+    def register(fn):
+        for tag in tags:
+            table[tag] = fn
+        return fn
+    return register
+
+
+# None of the traversals below are limited by Python's recursion limit, so a
+# list of a few hundred thousand cells or a long left-nested chain of
+# operators can be evaluated and printed. The hot ones (substitute, step)
+# recurse while the term is shallow, which is faster in Python, and hand
+# over to an explicit-stack version below RECURSION_DEPTH; the others always
+# use an explicit stack.
+RECURSION_DEPTH = 200
 
-    if tag == "var":
-        return t[1]
 
-    if tag == "num":
-        return str(t[1])
+# --------------------------------------------------------------------
+# Pretty printer
+# --------------------------------------------------------------------
+
+BINOP_SYMBOLS = {
+    "plus": " + ",
+    "minus": " - ",
+    "times": " * ",
+    "eq": " == ",
+    "leq": " <= ",
+}
 
-    if tag == "lam":
-        body = linearize(t[2], top=False)
-        s = f"(\\{t[1]}.{body})"
-        return s
-
-    if tag == "app":
-        f = linearize(t[1], top=False)
-        a = linearize(t[2], top=False)
-        s = f"{f} {a}"
-        # Always parenthesize applications to match tests
-        return f"({s})"
-
-    if tag == "plus":
-        left = linearize(t[1], top=False)
-        right = linearize(t[2], top=False)
-        s = f"{left} + {right}"
-        return f"({s})" if not top else s
-
-    if tag == "minus":
-        left = linearize(t[1], top=False)
-        right = linearize(t[2], top=False)
-        s = f"{left} - {right}"
-        return f"({s})" if not top else s
-
-    if tag == "times":
-        left = linearize(t[1], top=False)
-        right = linearize(t[2], top=False)
-        s = f"{left} * {right}"
-        return f"({s})" if not top else s
-
-    if tag == "neg":
-        inner = linearize(t[1], top=False)
-        s = f"-{inner}"
-        return s
-
-    if tag == "if":
-        cond = linearize(t[1], top=False)
-        then_branch = linearize(t[2], top=False)
-        else_branch = linearize(t[3], top=False)
-        s = f"if {cond} then {then_branch} else {else_branch}"
-        return s if top else f"({s})"
-
-    if tag == "eq":
-        left = linearize(t[1], top=False)
-        right = linearize(t[2], top=False)
-        s = f"{left} == {right}"
-        return s if top else f"({s})"
-
-    if tag == "leq":
-        left = linearize(t[1], top=False)
-        right = linearize(t[2], top=False)
-        s = f"{left} <= {right}"
-        return s if top else f"({s})"
-
-    if tag == "let":
-        var_name = t[1]
-        value = linearize(t[2], top=False)
-        body = linearize(t[3], top=False)
-        s = f"let {var_name} = {value} in {body}"
-        return s if top else f"({s})"
-
-    if tag == "letrec":
-        var_name = t[1]
-        value = linearize(t[2], top=False)
-        body = linearize(t[3], top=False)
-        s = f"letrec {var_name} = {value} in {body}"
-        return s if top else f"({s})"
-
-    if tag == "fix":
-        inner = linearize(t[1], top=False)
-        s = f"fix {inner}"
-        return s if top else f"({s})"
-
-    if tag == "prog":
-        # Since cons always adds its own parens now, just linearize both sides
-        left = linearize(t[1], top=True)
-        right = linearize(t[2], top=True)
-        return f"{left} ;; {right}"
-
-    if tag == "nil":
-        return "#"
+# tag -> handler(t, top, work) for constructs linearize() does not know:
+# pushes the pieces of t onto its work list, in reverse so they pop in
+# reading order. Strings are output as they are; (node, top) pairs are
+# printed in turn. The built-in constructs stay a chain of comparisons in
+# linearize() itself: a call per node measured slower (bench_dispatch.py).
+PRINTERS = {}
 
-    if tag == "cons":
-        head = linearize(t[1], top=False)
-        tail = linearize(t[2], top=False)
-        s = f"{head} : {tail}"
-        # Always parenthesize cons expressions
-        return f"({s})"
 
-    if tag == "hd":
-        inner = linearize(t[1], top=False)
-        s = f"hd {inner}"
-        # Always parenthesize hd
-        return f"({s})"
+def _print_unknown(t, top, work):
+    work.append("?")
 
-    if tag == "tl":
-        inner = linearize(t[1], top=False)
-        s = f"tl {inner}"
-        # Always parenthesize tl
-        return f"({s})"
 
-    return "?"
+def linearize(t, top=True):
+    # Work list of pending output: strings are emitted as they are,
+    # (node, top) pairs are expanded into their pieces. Pieces are pushed in
+    # reverse so they pop in reading order.
+    out = []
+    work = [(t, top)]
+
+    while work:
+        item = work.pop()
+        if type(item) is str:
+            out.append(item)
+            continue
+
+        t, top = item
+        tag = t[0]
+
+        if tag == "var":
+            out.append(t[1])
+
+        elif tag == "num":
+            out.append(str(t[1]))
+
+        elif tag == "nil":
+            out.append("#")
+
+        elif tag == "lam":
+            work += [")", (t[2], False), ".", t[1], "(\\"]
+
+        elif tag == "app":
+            # Always parenthesize applications to match tests
+            work += [")", (t[2], False), " ", (t[1], False), "("]
+
+        elif tag in ("plus", "minus", "times"):
+            # parenthesized unless at the top
+            if not top:
+                work.append(")")
+            work += [(t[2], False), BINOP_SYMBOLS[tag], (t[1], False)]
+            if not top:
+                work.append("(")
+
+        elif tag == "neg":
+            work += [(t[1], False), "-"]
+
+        elif tag in ("if", "eq", "leq", "let", "letrec", "fix"):
+            # parenthesized unless at the top
+            if not top:
+                work.append(")")
+            if tag == "if":
+                work += [(t[3], False), " else ", (t[2], False), " then ",
+                         (t[1], False), "if "]
+            elif tag in ("let", "letrec"):
+                work += [(t[3], False), " in ", (t[2], False), " = ", t[1],
+                         tag + " "]
+            elif tag == "fix":
+                work += [(t[1], False), "fix "]
+            else:
+                work += [(t[2], False), BINOP_SYMBOLS[tag], (t[1], False)]
+            if not top:
+                work.append("(")
+
+        elif tag == "prog":
+            # Since cons always adds its own parens now, just linearize both sides
+            work += [(t[2], True), " ;; ", (t[1], True)]
+
+        elif tag == "cons":
+            # Always parenthesize cons expressions
+            work += [")", (t[2], False), " : ", (t[1], False), "("]
+
+        elif tag == "list":
+            # Printed like the cons cells it stands for
+            rest, items, lo, hi = t[1], t[2], t[3], t[4]
+            work.append(")" * (hi - lo))
+            work.append((rest, False))
+            for x in reversed(items[lo:hi]):
+                work += (" : ", str(x[1]) if x[0] == "num" else (x, False), "(")
+
+        elif tag in ("hd", "tl"):
+            # Always parenthesize hd and tl
+            work += [")", (t[1], False), "(" + tag + " "]
+
+        else:
+            PRINTERS.get(tag, _print_unknown)(t, top, work)
+
+    return "".join(out)
 
 
 # --------------------------------------------------------------------
 # Free variables and substitution
 # --------------------------------------------------------------------
 
-def free_vars(t):
+def children(t):
+    """Subterms of t, in source order (binder names are not subterms)"""
     tag = t[0]
+    if tag in ("var", "num", "nil"):
+        return ()
+    if tag == "lam":
+        return (t[2],)
+    if tag in ("let", "letrec"):
+        return (t[2], t[3])
+    if tag == "list":
+        return (t[1],)
+    return t[1:]
+
+
+# Free-variable sets are cached per node. The cache is keyed by id() and
+# keeps the node alive, so an id cannot be reused while its entry exists.
+# A rewrite shares almost all of its subterms with the term before it, so
+# only the freshly built nodes ever need their set computed.
+_fv_cache = {}
+FV_CACHE_LIMIT = 1 << 20
 
+_NO_FV = frozenset()
+
+
+def _cached_fv(t, depth=0):
+    tag = t[0]
     if tag == "var":
-        return {t[1]}
+        return frozenset((t[1],))
+    if tag in ("num", "nil"):
+        return _NO_FV
+    hit = _fv_cache.get(id(t))
+    return None if hit is None else hit[1]
 
-    if tag == "lam":
-        return free_vars(t[2]) - {t[1]}
 
-    if tag == "app":
-        return free_vars(t[1]) | free_vars(t[2])
+# tag -> handler(t, fv, depth): the free variables of t, given
+# fv(child, depth) for its subterms. Variables, numbers and nil are handled before the lookup.
+FREE_VARS = {}
+
+
+@handles(FREE_VARS, "lam")
+def _fv_lam(t, fv, depth):
+    return fv(t[2], depth) - {t[1]}
+
+
+@handles(FREE_VARS, "let")
+def _fv_let(t, fv, depth):
+    return fv(t[2], depth) | (fv(t[3], depth) - {t[1]})
+
 
-    if tag in ("plus", "minus", "times", "eq", "leq", "cons"):
-        return free_vars(t[1]) | free_vars(t[2])
+@handles(FREE_VARS, "letrec")
+def _fv_letrec(t, fv, depth):
+    return (fv(t[2], depth) | fv(t[3], depth)) - {t[1]}
 
-    if tag in ("neg", "hd", "tl"):
-        return free_vars(t[1])
 
-    if tag == "if":
-        return free_vars(t[1]) | free_vars(t[2]) | free_vars(t[3])
+@handles(FREE_VARS, "app", "plus", "minus", "times", "eq", "leq", "cons", "prog")
+def _fv_pair(t, fv, depth):
+    return fv(t[1], depth) | fv(t[2], depth)
 
-    if tag == "let":
-        var_name = t[1]
-        return free_vars(t[2]) | (free_vars(t[3]) - {var_name})
 
-    if tag == "letrec":
-        var_name = t[1]
-        return (free_vars(t[2]) | free_vars(t[3])) - {var_name}
+@handles(FREE_VARS, "neg", "hd", "tl", "fix", "list")
+def _fv_unary(t, fv, depth):
+    return fv(t[1], depth)
 
-    if tag == "fix":
-        return free_vars(t[1])
 
-    if tag == "prog":
-        return free_vars(t[1]) | free_vars(t[2])
+@handles(FREE_VARS, "if")
+def _fv_if(t, fv, depth):
+    return fv(t[1], depth) | fv(t[2], depth) | fv(t[3], depth)
+
+
+def free_vars(t, depth=0, stats=None):
+    """
+    Free variables of t, cached per node. stats (see evaluate_iter), if
+    given, counts the calls.
+    """
+    if stats is not None:
+        stats.free_vars_calls += 1
+    tag = t[0]
+
+    if tag == "var":
+        return frozenset((t[1],))
 
     if tag in ("num", "nil"):
-        return set()
+        return _NO_FV
+
+    hit = _fv_cache.get(id(t))
+    if hit is not None:
+        return hit[1]
+
+    if depth > RECURSION_DEPTH:
+        return _free_vars_deep(t)
+    depth += 1
+
+    if stats is None:
+        fv = FREE_VARS[tag](t, free_vars, depth)
+    else:
+        fv = FREE_VARS[tag](t, lambda c, depth: free_vars(c, depth, stats), depth)
+
+    if len(_fv_cache) >= FV_CACHE_LIMIT:
+        _fv_cache.clear()
+    _fv_cache[id(t)] = (t, fv)
+    return fv
 
-    return set()
 
+def _free_vars_deep(t):
+    """free_vars() with an explicit stack, for deep terms"""
+    # Post-order walk over the nodes that are not cached yet
+    stack = [t]
+    while stack:
+        node = stack[-1]
+        if _cached_fv(node) is not None:
+            stack.pop()
+            continue
+
+        pending = [c for c in children(node) if _cached_fv(c) is None]
+        if pending:
+            stack += pending
+            continue
+
+        stack.pop()
+        _fv_cache[id(node)] = (node, FREE_VARS[node[0]](node, _cached_fv, 0))
+
+    return _fv_cache[id(t)][1]
+
+
+class NameGen(threading.local):
+    """
+    Fresh names Var1, Var2, ... not in used. The counter is per thread and
+    interpret() restarts it, so the names in a printed result depend only on
+    the program; renaming stays capture-free whatever the counter, since a
+    name is only ever checked against used.
+    """
 
-class NameGen:
     def __init__(self):
         self.c = 0
 
-    def fresh(self, used):
+    def reset(self):
+        self.c = 0
+
+    def fresh(self, used, stats=None):
+        if stats is not None:
+            stats.fresh_names += 1
         while True:
             self.c += 1
             x = f"Var{self.c}"
@@ -246,96 +469,253 @@ class NameGen:
 ng = NameGen()
 
 
-def substitute(t, name, rep):
+# tag -> plan(t, name, rep, stats) for the binders, where substituting is more than
+# substituting into every subterm. A plan returns (prefix, kids, suffix): the
+# result is prefix + the substituted kids + suffix. Capture-avoiding renames
+# happen here, before the kids are visited.
+SUBST_PLANS = {}
+
+
+@handles(SUBST_PLANS, "lam")
+def _subst_lam(t, name, rep, stats):
+    v, body = t[1], t[2]
+    if v in free_vars(rep, 0, stats):
+        used = free_vars(body, 0, stats) | free_vars(rep, 0, stats) | {v, name}
+        fresh = ng.fresh(used, stats)
+        return ("lam", fresh), (substitute(body, v, mk("var", fresh), 0, stats),), ()
+    return ("lam", v), (body,), ()
+
+
+@handles(SUBST_PLANS, "let")
+def _subst_let(t, name, rep, stats):
+    var_name, value, body = t[1], t[2], t[3]
+    if var_name == name:
+        # Variable is shadowed
+        return ("let", var_name), (value,), (body,)
+    if var_name in free_vars(rep, 0, stats):
+        # Need to rename to avoid capture
+        used = free_vars(body, 0, stats) | free_vars(rep, 0, stats) | {var_name, name}
+        fresh = ng.fresh(used, stats)
+        renamed_body = substitute(body, var_name, mk("var", fresh), 0, stats)
+        return ("let", fresh), (value, renamed_body), ()
+    return ("let", var_name), (value, body), ()
+
+
+@handles(SUBST_PLANS, "letrec")
+def _subst_letrec(t, name, rep, stats):
+    var_name, value, body = t[1], t[2], t[3]
+    if var_name in free_vars(rep, 0, stats):
+        # Need to rename to avoid capture
+        used = (free_vars(value, 0, stats) | free_vars(body, 0, stats)
+                | free_vars(rep, 0, stats) | {var_name, name})
+        fresh = ng.fresh(used, stats)
+        fresh_var = mk("var", fresh)
+        renamed_value = substitute(value, var_name, fresh_var, 0, stats)
+        renamed_body = substitute(body, var_name, fresh_var, 0, stats)
+        return ("letrec", fresh), (renamed_value, renamed_body), ()
+    return ("letrec", var_name), (value, body), ()
+
+
+@handles(SUBST_PLANS, "list")
+def _subst_list(t, name, rep, stats):
+    # only the rest can have free variables; the items are closed data
+    return ("list",), (t[1],), t[2:]
+
+
+def _subst_plan(t, name, rep, stats=None):
+    """How to substitute into a node where name occurs free"""
+    if stats is not None:
+        stats.nodes_copied += 1
+    plan = SUBST_PLANS.get(t[0])
+    if plan is not None:
+        return plan(t, name, rep, stats)
+    # app, arithmetic, comparisons, if, fix, prog, lists
+    return (t[0],), t[1:], ()
+
+
+def substitute(t, name, rep, depth=0, stats=None):
+    """
+    Capture-avoiding t[rep/name]. stats (see evaluate_iter), if given,
+    counts the calls and the nodes copied.
+    """
+    if stats is not None:
+        stats.substitute_calls += 1
     tag = t[0]
-
     if tag == "var":
         return rep if t[1] == name else t
 
-    if tag == "lam":
-        v, body = t[1], t[2]
-        if v == name:
-            return t
-        if v in free_vars(rep):
-            used = free_vars(body) | free_vars(rep) | {v, name}
-            fresh = ng.fresh(used)
-            renamed_body = substitute(body, v, ("var", fresh))
-            return ("lam", fresh, substitute(renamed_body, name, rep))
-        return ("lam", v, substitute(body, name, rep))
-
-    if tag == "app":
-        return (
-            "app",
-            substitute(t[1], name, rep),
-            substitute(t[2], name, rep),
-        )
-
-    if tag in ("plus", "minus", "times", "eq", "leq", "cons"):
-        return (
-            tag,
-            substitute(t[1], name, rep),
-            substitute(t[2], name, rep),
-        )
-
-    if tag in ("neg", "hd", "tl"):
-        return (tag, substitute(t[1], name, rep))
-
-    if tag == "if":
-        return (
-            "if",
-            substitute(t[1], name, rep),
-            substitute(t[2], name, rep),
-            substitute(t[3], name, rep),
-        )
-
-    if tag == "let":
-        var_name = t[1]
-        new_value = substitute(t[2], name, rep)
-        if var_name == name:
-            # Variable is shadowed
-            return ("let", var_name, new_value, t[3])
-        if var_name in free_vars(rep):
-            # Need to rename to avoid capture
-            used = free_vars(t[3]) | free_vars(rep) | {var_name, name}
-            fresh = ng.fresh(used)
-            renamed_body = substitute(t[3], var_name, ("var", fresh))
-            new_body = substitute(renamed_body, name, rep)
-            return ("let", fresh, new_value, new_body)
-        return ("let", var_name, new_value, substitute(t[3], name, rep))
-
-    if tag == "letrec":
-        var_name = t[1]
-        if var_name == name:
-            # Variable is shadowed
-            return t
-        if var_name in free_vars(rep):
-            # Need to rename to avoid capture
-            used = free_vars(t[2]) | free_vars(t[3]) | free_vars(rep) | {var_name, name}
-            fresh = ng.fresh(used)
-            renamed_value = substitute(t[2], var_name, ("var", fresh))
-            renamed_body = substitute(t[3], var_name, ("var", fresh))
-            new_value = substitute(renamed_value, name, rep)
-            new_body = substitute(renamed_body, name, rep)
-            return ("letrec", fresh, new_value, new_body)
-        return (
-            "letrec",
-            var_name,
-            substitute(t[2], name, rep),
-            substitute(t[3], name, rep),
-        )
+    # Nothing to replace below here: share the subtree instead of copying it
+    hit = _fv_cache.get(id(t))
+    if name not in (hit[1] if hit is not None else free_vars(t, 0, stats)):
+        return t
+
+    if depth > RECURSION_DEPTH:
+        return _substitute_deep(t, name, rep, stats)
+    depth += 1
+
+    plan = SUBST_PLANS.get(tag)
+    if stats is not None:
+        stats.nodes_copied += 1
+    if plan is not None:
+        prefix, kids, suffix = plan(t, name, rep, stats)
+        return mk(*prefix, *[substitute(k, name, rep, depth, stats) for k in kids], *suffix)
+
+    # app, arithmetic, comparisons, if, fix, prog, lists
+    if len(t) == 3:
+        return _mk2(tag, substitute(t[1], name, rep, depth, stats),
+                    substitute(t[2], name, rep, depth, stats))
+    if len(t) == 2:
+        return mk(tag, substitute(t[1], name, rep, depth, stats))
+    return mk(tag, *[substitute(k, name, rep, depth, stats) for k in t[1:]])
+
+
+def _substitute_deep(t, name, rep, stats=None):
+    """substitute() with an explicit stack, for arbitrarily deep terms"""
+    # frames of [prefix, kids, suffix, substituted kids so far]
+    prefix, kids, suffix = _subst_plan(t, name, rep, stats)
+    stack = [[prefix, kids, suffix, []]]
+
+    while True:
+        frame = stack[-1]
+        kids, done = frame[1], frame[3]
+        i = len(done)
+        while i < len(kids):
+            kid = kids[i]
+            if kid[0] == "var":
+                done.append(rep if kid[1] == name else kid)
+            elif name not in free_vars(kid, 0, stats):
+                done.append(kid)
+            else:
+                prefix, grandkids, suffix = _subst_plan(kid, name, rep, stats)
+                stack.append([prefix, grandkids, suffix, []])
+                break
+            i += 1
+        else:
+            stack.pop()
+            result = mk(*frame[0], *done, *frame[2])
+            if not stack:
+                return result
+            stack[-1][3].append(result)
 
-    if tag == "fix":
-        return ("fix", substitute(t[1], name, rep))
 
-    if tag == "prog":
-        return (
-            "prog",
-            substitute(t[1], name, rep),
-            substitute(t[2], name, rep),
-        )
+# --------------------------------------------------------------------
+# Packed lists
+# --------------------------------------------------------------------
 
-    # numbers, nil, and others
-    return t
+# As cons cells, a list of n values is n nested nodes, and every step,
+# comparison or print walks all of them. Once the head of a cons is data
+# (a number, nil, or a packed list ending in nil), the evaluator stores it
+# packed instead:
+#
+#     ("list", rest, items, lo, hi)   items[lo] : ... : items[hi - 1] : rest
+#
+# items is a Python list shared by the nodes built from one another, and
+# lo < hi. rest is any term, and is what step() goes on reducing: a list
+# built front to back (f x : map f xs) grows at the end of items, one
+# built back to front (x : acc) into free slots (None) in front of lo, so
+# hd, tl and both kinds of cons cost O(1) (amortized; the buffer is copied
+# when the slot is taken or there is no room). A node never changes the
+# part of items it covers, so sharing is safe. The buffers are not
+# locked: two threads must not evaluate terms that share a list.
+#
+# Packed lists never leave the evaluator: evaluate(), evaluate_iter() and
+# LimitExceeded hand out terms with the lists turned back into interned
+# cons cells (unpack), so the parser, optimize.py, arena.py, debruijn.py
+# and the other backends only ever see cons cells, and equal values are
+# one object as elsewhere.
+
+def _is_data(t):
+    """Whether t is closed, fully evaluated data that a list can hold"""
+    tag = t[0]
+    return tag == "num" or tag == "nil" or (tag == "list" and t[1][0] == "nil")
+
+
+def _cons(head, tail):
+    """The value of head : tail, packed when head is data"""
+    if not _is_data(head):
+        return _mk2("cons", head, tail)
+    if tail[0] != "list":
+        return ("list", tail, [head], 0, 1)
+
+    rest, items, lo, hi = tail[1], tail[2], tail[3], tail[4]
+    if lo > 0:
+        if items[lo - 1] is None:
+            items[lo - 1] = head
+        if items[lo - 1] is head:
+            return ("list", rest, items, lo - 1, hi)
+    # copy, with as much room in front as there are items
+    n = hi - lo
+    new = [None] * n + items[lo:hi]
+    new[n - 1] = head
+    return ("list", rest, new, n - 1, 2 * n)
+
+
+def _extend(t, rest):
+    """The packed list t with its rest replaced by rest"""
+    if rest[0] != "list":
+        return ("list", rest, t[2], t[3], t[4])
+
+    # a packed rest is appended to t's items
+    extra = rest[2][rest[3]:rest[4]]
+    items, lo, hi = t[2], t[3], t[4]
+    if len(items) == hi:
+        items += extra
+    k = len(extra)
+    if not (len(items) >= hi + k and all(a is b for a, b in zip(items[hi:hi + k], extra))):
+        items = items[lo:hi] + extra
+        lo, hi = 0, hi - lo
+    return ("list", rest[1], items, lo, hi + k)
+
+
+def unpack(t):
+    """t with every packed list in it turned back into interned cons cells"""
+    done = {}   # id(node) -> node unpacked; t keeps the nodes alive
+    work = [t]
+    while work:
+        node = work[-1]
+        if id(node) in done:
+            work.pop()
+            continue
+        tag = node[0]
+        if tag == "list":
+            kids = [node[1]] + node[2][node[3]:node[4]]
+        else:
+            kids = children(node)
+        pending = [k for k in kids if id(k) not in done]
+        if pending:
+            work += pending
+            continue
+
+        work.pop()
+        if tag == "list":
+            new = done[id(node[1])]
+            for x in reversed(node[2][node[3]:node[4]]):
+                new = _mk2("cons", done[id(x)], new)
+        elif all(done[id(k)] is k for k in kids):
+            new = node
+        elif tag == "lam":
+            new = mk("lam", node[1], done[id(node[2])])
+        elif tag in ("let", "letrec"):
+            new = mk(tag, node[1], done[id(node[2])], done[id(node[3])])
+        else:
+            new = mk(tag, *[done[id(k)] for k in kids])
+        done[id(node)] = new
+    return done[id(t)]
+
+
+def _list_tail(t):
+    """tl of the packed list t"""
+    lo = t[3] + 1
+    return ("list", t[1], t[2], lo, t[4]) if lo < t[4] else t[1]
+
+
+def _uncons(v):
+    """(head, tail) of a cons cell or packed list, or None"""
+    if v[0] == "cons":
+        return v[1], v[2]
+    if v[0] == "list":
+        return v[2][v[3]], _list_tail(v)
+    return None
 
 
 # --------------------------------------------------------------------
@@ -344,279 +724,895 @@ def substitute(t, name, rep):
 
 MAX_STEPS = 500000
 
+# what interpret() prints for a program that runs out of steps
+NON_TERMINATING = "<non-terminating>"
+
 
 def values_equal(v1, v2):
     """Check if two values are structurally equal"""
-    # Both are numbers
-    if v1[0] == "num" and v2[0] == "num":
-        return v1[1] == v2[1]
-    
-    # Both are nil
-    if v1[0] == "nil" and v2[0] == "nil":
-        return True
-    
-    # Both are cons
-    if v1[0] == "cons" and v2[0] == "cons":
-        # Recursively check head and tail
-        heads_equal = values_equal(v1[1], v2[1])
-        tails_equal = values_equal(v1[2], v2[2])
-        return heads_equal and tails_equal
-    
-    # Different types or other cases
-    return False
-
-
-def step(t):
-    tag = t[0]
+    pairs = [(v1, v2)]
+    while pairs:
+        v1, v2 = pairs.pop()
+
+        # Interned data: equal lists are one object
+        if v1 is v2 and id(v1) in _literals:
+            continue
+
+        # Both are numbers
+        if v1[0] == "num" and v2[0] == "num":
+            if v1[1] != v2[1]:
+                return False
+
+        # Both are nil
+        elif v1[0] == "nil" and v2[0] == "nil":
+            pass
+
+        # Both are cons: check head and tail
+        elif v1[0] == "cons" and v2[0] == "cons":
+            pairs.append((v1[2], v2[2]))
+            pairs.append((v1[1], v2[1]))
+
+        # Both are packed: check the items they have in common in one go
+        elif v1[0] == "list" and v2[0] == "list":
+            n = min(v1[4] - v1[3], v2[4] - v2[3])
+            rest1 = ("list", v1[1], v1[2], v1[3] + n, v1[4]) if v1[3] + n < v1[4] else v1[1]
+            rest2 = ("list", v2[1], v2[2], v2[3] + n, v2[4]) if v2[3] + n < v2[4] else v2[1]
+            pairs.append((rest1, rest2))
+            if not (v1[2] is v2[2] and v1[3] == v2[3]):
+                pairs += zip(v1[2][v1[3]:v1[3] + n], v2[2][v2[3]:v2[3] + n])
+
+        # A cons and a packed list
+        elif v1[0] in ("cons", "list") and v2[0] in ("cons", "list"):
+            (h1, t1), (h2, t2) = _uncons(v1), _uncons(v2)
+            pairs.append((t1, t2))
+            pairs.append((h1, h2))
+
+        # Different types or other cases
+        else:
+            return False
+
+    return True
+
+
+# Which subterms step() reduces, in order, before trying the node's own rule:
+# always the first, sometimes the second. Nodes not listed (variables,
+# numbers, nil, lambdas, let, letrec) have no reducible subterms.
+STEP_CHILDREN = {
+    "app": (1, 2),
+    "cons": (1, 2),
+    "prog": (1, 2),
+    "plus": (1, 2),
+    "minus": (1, 2),
+    "times": (1, 2),
+    "eq": (1, 2),
+    "leq": (1, 2),
+    "neg": (1,),
+    "if": (1,),
+    "fix": (1,),
+    "hd": (1,),
+    "tl": (1,),
+    "list": (1,),
+}
+
+
+# tag -> rule(t, stats) that fires before the subterms are reduced, or after
+# they are irreducible; a rule returns the reduct, or None if it does not
+# apply. stats is passed on to substitute().
+STEP_BEFORE = {}
+STEP_AFTER = {}
+
+
+@handles(STEP_BEFORE, "app")
+def _step_beta(t, stats):
+    # Beta-reduction when function is a lambda
+    if t[1][0] == "lam":
+        v, body = t[1][1], t[1][2]
+        return substitute(body, v, t[2], 0, stats)
+    return None
+
+
+@handles(STEP_BEFORE, "let")
+def _step_let(t, stats):
+    # Let: desugar to application
+    # let x = e1 in e2  -->  (\x.e2) e1
+    var_name, value, body = t[1], t[2], t[3]
+    return mk("app", mk("lam", var_name, body), value)
 
-    # Values that do not reduce
-    if tag in ("var", "num", "nil"):
-        return t, False
 
-    # Lazy semantics: do not reduce under lambda
-    if tag == "lam":
-        return t, False
+@handles(STEP_BEFORE, "letrec")
+def _step_letrec(t, stats):
+    # Letrec: desugar using fix
+    # letrec f = e1 in e2  -->  let f = (fix (\f.e1)) in e2
+    var_name, value, body = t[1], t[2], t[3]
+    fixed_value = mk("fix", mk("lam", var_name, value))
+    return mk("let", var_name, fixed_value, body)
 
-    # Cons is a value (data constructor)
-    # We evaluate the head and tail fully
-    if tag == "cons":
-        head, tail = t[1], t[2]
-        
-        # Reduce head
-        new_head, changed = step(head)
-        if changed:
-            return ("cons", new_head, tail), True
-        
-        # Reduce tail
-        new_tail, changed = step(tail)
-        if changed:
-            return ("cons", head, new_tail), True
-        
-        # Both fully reduced, cons is now a value
-        return t, False
 
-    # Application
-    if tag == "app":
-        f, a = t[1], t[2]
+ARITHMETIC = {
+    "plus": operator.add,
+    "minus": operator.sub,
+    "times": operator.mul,
+}
 
-        # Beta-reduction when function is a lambda
-        if f[0] == "lam":
-            v, body = f[1], f[2]
-            return substitute(body, v, a), True
 
-        # Otherwise reduce the function first
-        new_f, changed = step(f)
-        if changed:
-            return ("app", new_f, a), True
+@handles(STEP_AFTER, "plus", "minus", "times")
+def _step_arithmetic(t, stats):
+    # Binary arithmetic on two numbers
+    left, right = t[1], t[2]
+    if left[0] == "num" and right[0] == "num":
+        return mk("num", float(ARITHMETIC[t[0]](left[1], right[1])))
+    return None
 
-        # Then reduce the argument
-        new_a, changed = step(a)
-        return ("app", f, new_a), changed
 
-    # Binary arithmetic
-    if tag in ("plus", "minus", "times"):
-        op = tag
-        left, right = t[1], t[2]
+@handles(STEP_AFTER, "neg")
+def _step_neg(t, stats):
+    # Unary minus
+    inner = t[1]
+    if inner[0] == "num":
+        return mk("num", float(-inner[1]))
+    return None
+
+
+@handles(STEP_AFTER, "if")
+def _step_if(t, stats):
+    # If-then-else: branch once the condition is a number
+    cond = t[1]
+    if cond[0] == "num":
+        if cond[1] == 1.0:
+            return t[2]
+        elif cond[1] == 0.0:
+            return t[3]
+    return None
+
+
+@handles(STEP_AFTER, "eq")
+def _step_eq(t, stats):
+    # Use structural equality for all values
+    result = 1.0 if values_equal(t[1], t[2]) else 0.0
+    return mk("num", result)
+
+
+@handles(STEP_AFTER, "leq")
+def _step_leq(t, stats):
+    # leq only works on numbers
+    left, right = t[1], t[2]
+    if left[0] == "num" and right[0] == "num":
+        result = 1.0 if left[1] <= right[1] else 0.0
+        return mk("num", result)
+    return None
+
+
+@handles(STEP_AFTER, "fix")
+def _step_fix(t, stats):
+    # Fix: fixed-point combinator
+    # fix F  -->  F (fix F), only when the function is a lambda
+    # This prevents infinite expansion
+    func = t[1]
+    if func[0] == "lam":
+        return mk("app", func, mk("fix", func))
+    return None
 
-        # Reduce left
-        new_left, changed = step(left)
-        if changed:
-            return (op, new_left, right), True
 
-        # Reduce right
-        new_right, changed = step(right)
-        if changed:
-            return (op, left, new_right), True
-
-        # Both numeric: perform operation
-        if left[0] == "num" and right[0] == "num":
-            lv, rv = left[1], right[1]
-            if op == "plus":
-                val = lv + rv
-            elif op == "minus":
-                val = lv - rv
-            else:  # times
-                val = lv * rv
-            return ("num", float(val)), True
+@handles(STEP_AFTER, "hd")
+def _step_hd(t, stats):
+    # Head: hd (a:b) --> a
+    if t[1][0] == "cons":
+        return t[1][1]
+    if t[1][0] == "list":
+        return t[1][2][t[1][3]]
+    return None
 
-        return t, False
 
-    # Unary minus
-    if tag == "neg":
-        inner = t[1]
-        new_inner, changed = step(inner)
-        if changed:
-            return ("neg", new_inner), True
-        if inner[0] == "num":
-            return ("num", float(-inner[1])), True
-        return t, False
+@handles(STEP_AFTER, "tl")
+def _step_tl(t, stats):
+    # Tail: tl (a:b) --> b
+    if t[1][0] == "cons":
+        return t[1][2]
+    if t[1][0] == "list":
+        return _list_tail(t[1])
+    return None
 
-    # If-then-else
-    if tag == "if":
-        cond, then_branch, else_branch = t[1], t[2], t[3]
-        
-        # Reduce condition first
-        new_cond, changed = step(cond)
-        if changed:
-            return ("if", new_cond, then_branch, else_branch), True
-        
-        # If condition is a number, branch
-        if cond[0] == "num":
-            if cond[1] == 1.0:
-                return then_branch, True
-            elif cond[1] == 0.0:
-                return else_branch, True
-        
-        return t, False
 
-    # Comparison operators
-    if tag in ("eq", "leq"):
-        left, right = t[1], t[2]
-        
-        # Reduce left
-        new_left, changed = step(left)
-        if changed:
-            return (tag, new_left, right), True
-        
-        # Reduce right
-        new_right, changed = step(right)
-        if changed:
-            return (tag, left, new_right), True
-        
-        # Both reduced - now compare
-        if tag == "eq":
-            # Use structural equality for all values
-            result = 1.0 if values_equal(left, right) else 0.0
-            return ("num", result), True
-        
-        # leq only works on numbers
-        if tag == "leq":
-            if left[0] == "num" and right[0] == "num":
-                result = 1.0 if left[1] <= right[1] else 0.0
-                return ("num", result), True
-        
-        return t, False
+@handles(STEP_AFTER, "cons")
+def _step_pack(t, stats):
+    # A cons of data onto a value is packed (see _cons)
+    if _is_data(t[1]):
+        return _cons(t[1], t[2])
+    return None
 
-    # Let: desugar to application
-    # let x = e1 in e2  -->  (\x.e2) e1
-    if tag == "let":
-        var_name, value, body = t[1], t[2], t[3]
-        return ("app", ("lam", var_name, body), value), True
 
-    # Letrec: desugar using fix
-    # letrec f = e1 in e2  -->  let f = (fix (\f.e1)) in e2
-    if tag == "letrec":
-        var_name, value, body = t[1], t[2], t[3]
-        fixed_value = ("fix", ("lam", var_name, value))
-        return ("let", var_name, fixed_value, body), True
+@handles(STEP_AFTER, "list")
+def _step_join(t, stats):
+    # A packed list whose rest is packed (after a substitution) is joined
+    if t[1][0] == "list":
+        return _extend(t, t[1])
+    return None
 
-    # Fix: fixed-point combinator
-    # fix F  -->  F (fix F)
-    if tag == "fix":
-        func = t[1]
-        
-        # Reduce the function first
-        new_func, changed = step(func)
-        if changed:
-            return ("fix", new_func), True
-        
-        # Only expand fix when the function is a lambda
-        # This prevents infinite expansion
-        if func[0] == "lam":
-            # Apply the reduction: fix F --> F (fix F)
-            return ("app", func, ("fix", func)), True
-        
-        return t, False
 
-    # Prog: evaluate both sides
-    if tag == "prog":
-        left, right = t[1], t[2]
-        
-        # Reduce left
-        new_left, changed = step(left)
-        if changed:
-            return ("prog", new_left, right), True
-        
-        # Reduce right
-        new_right, changed = step(right)
-        if changed:
-            return ("prog", left, new_right), True
-        
-        # Both reduced
-        return t, False
+# prog is a value once both sides are, and so is a cons whose head is not
+# data; app is stuck: none of them has a rule in STEP_AFTER
 
-    # Head: hd (a:b) --> a
-    if tag == "hd":
-        inner = t[1]
-        
-        # Reduce the argument
-        new_inner, changed = step(inner)
-        if changed:
-            return ("hd", new_inner), True
-        
-        # If it's a cons, extract head
-        if inner[0] == "cons":
-            return inner[1], True
-        
+# the node whose rule the last step() fired, for evaluate_iter(events=True)
+last_redex = None
+
+
+def step(t, depth=0, stats=None):
+    """
+    One leftmost-outermost reduction. Returns (new_term, changed).
+
+    Values that do not reduce: variables, numbers, nil, and lambdas (lazy
+    semantics, no reduction under lambda). Cons is a data constructor whose
+    head and tail are reduced in turn; once its head is data it is packed,
+    and only the rest of a packed list is reduced. stats (see
+    evaluate_iter), if given, is told about the rule that fires.
+    """
+    global last_redex
+    tag = t[0]
+
+    before = STEP_BEFORE.get(tag)
+    if before is not None:
+        new = before(t, stats)
+        if new is not None:
+            last_redex = t
+            if stats is not None:
+                stats.fired(t, new)
+            return new, True
+
+    kids = STEP_CHILDREN.get(tag)
+    if kids is None:
+        # variables, numbers, nil and lambdas never reduce
         return t, False
 
-    # Tail: tl (a:b) --> b
-    if tag == "tl":
-        inner = t[1]
-        
-        # Reduce the argument
-        new_inner, changed = step(inner)
+    if depth > RECURSION_DEPTH:
+        return _step_deep(t, stats)
+    depth += 1
+
+    # Only data outlives reduction: every other node on the path to the
+    # redex is about to be rewritten again, so it is not worth interning
+    new, changed = step(t[1], depth, stats)
+    if changed:
+        if tag == "cons":
+            return _cons(new, t[2]), True
+        if tag == "list":
+            return _extend(t, new), True
+        return (tag, new) + t[2:], True
+
+    if len(kids) == 2:
+        new, changed = step(t[2], depth, stats)
         if changed:
-            return ("tl", new_inner), True
-        
-        # If it's a cons, extract tail
-        if inner[0] == "cons":
-            return inner[2], True
-        
+            return (_cons(t[1], new) if tag == "cons" else (tag, t[1], new)), True
+
+    after = STEP_AFTER.get(tag)
+    new = None if after is None else after(t, stats)
+    if new is None:
         return t, False
+    last_redex = t
+    if stats is not None:
+        stats.fired(t, new)
+    return new, True
+
+
+def _step_deep(t, stats=None):
+    """step() with an explicit path instead of recursion, for deep terms"""
+    focus = _Focus(t, stats)
+    changed = focus.step()
+    return focus.term(), changed
+
+
+def _rebuild(parent, pos, new):
+    """parent with its subterm at pos replaced by new, as step() does it"""
+    if parent[pos] is new:
+        return parent
+    tag = parent[0]
+    if tag == "cons":
+        return _cons(new, parent[2]) if pos == 1 else _cons(parent[1], new)
+    if tag == "list":
+        return _extend(parent, new)
+    return parent[:pos] + (new,) + parent[pos + 1:]
+
+
+class _Focus:
+    """
+    A term reduced one step() at a time, kept as the path down to where the
+    last reduction happened so that the next one need not walk down from
+    the root and rebuild every node above it again. A reduction rebuilds
+    its consecutive cons and list ancestors, whose shape can change as
+    their items are packed, and the first other ancestor, which is then
+    searched again; the nodes above that have only its old version, and are
+    rebuilt as the search goes back up through them or by term().
+
+    Nothing above the first other ancestor changes tag, so the before rules
+    there need not run again; that holds as long as a before rule looks no
+    deeper than the tags of a node's subterms, as beta reduction does.
+    """
+
+    __slots__ = ("path", "node", "index", "stats")
+
+    def __init__(self, t, stats=None):
+        # [node, child positions, index into them] from the root down
+        self.path = []
+        # searched next, from its index-th subterm
+        self.node = t
+        self.index = 0
+        self.stats = stats
+
+    def term(self):
+        """The whole term as it stands"""
+        t = self.node
+        for parent, kids, i in reversed(self.path):
+            t = _rebuild(parent, kids[i], t)
+        return t
+
+    def step(self):
+        """One reduction as step() would make it; whether there was one"""
+        global last_redex
+        stats = self.stats
+        path = self.path
+        t, i = self.node, self.index
+
+        while True:
+            before = STEP_BEFORE.get(t[0])
+            new = None if before is None else before(t, stats)
+            kids = STEP_CHILDREN.get(t[0])
+            if new is None and kids is not None:
+                path.append([t, kids, i])
+                t, i = t[kids[i]], 0
+                continue
+
+            # t is irreducible: go on with the next sibling, or try the
+            # parent's own rule once all its subterms are irreducible
+            while new is None:
+                if not path:
+                    self.node, self.index = t, 0
+                    return False
+                frame = path[-1]
+                parent, kids, i = frame
+                if parent[kids[i]] is not t:
+                    # reduced below since the frame was pushed
+                    rebuilt = _rebuild(parent, kids[i], t)
+                    if rebuilt[0] != parent[0] or (rebuilt[0] == "list" and rebuilt[1] is not t):
+                        # packed or joined: search it again, as step() would
+                        path.pop()
+                        t, i = rebuilt, 0
+                        break
+                    frame[0] = parent = rebuilt
+                i += 1
+                if i < len(kids):
+                    frame[2] = i
+                    t, i = parent[kids[i]], 0
+                    break
+                path.pop()
+                t = parent
+                after = STEP_AFTER.get(t[0])
+                if after is not None:
+                    new = after(t, stats)
+            if new is None:
+                continue
+
+            last_redex = t
+            if stats is not None:
+                stats.fired(t, new)
+            i = 0
+            while path:
+                parent, kids, i = path.pop()
+                new = _rebuild(parent, kids[i], new)
+                if parent[0] != "cons" and parent[0] != "list":
+                    break
+                i = 0
+            self.node, self.index = new, i
+            return True
 
-    return t, False
 
+# --------------------------------------------------------------------
+# Loop detection
+# --------------------------------------------------------------------
+
+# step() is deterministic, and alpha-equivalent terms reduce to
+# alpha-equivalent terms, so once a state comes back up to the names of its
+# bound variables the evaluation repeats it forever. evaluate() fingerprints
+# a sample of the states and looks for a repeat with Brent's algorithm,
+# which keeps one saved state. The gap to the next sample is at least
+# LOOP_CHECK_EVERY steps and half the tokens in the last fingerprint, so
+# fingerprinting costs a few tokens per step on large terms. A state whose
+# fingerprint would pass KEY_LIMIT tokens is not checked.
+LOOP_CHECK_EVERY = 32
+KEY_LIMIT = 1 << 16
+
+# work list instructions of alpha_key
+_BIND, _UNBIND = 0, 1
+
+
+def alpha_key(t, limit=None):
+    """
+    t as a flat tuple, equal for two terms only if they are alpha-equivalent:
+    tags in preorder, bound variables as de Bruijn indices, binder names
+    dropped. A repeated closed literal (see mk) is a reference to where it
+    first appears. None once the key passes limit tokens.
+    """
+    out = []
+    scope = {}   # name -> depths of the binders of that name, innermost last
+    depth = 0
+    first = {}   # id of a literal -> its position in out
+    work = [t]
+    while work:
+        node = work.pop()
+        tag = node[0]
+
+        if tag is _BIND:
+            depth += 1
+            scope.setdefault(node[1], []).append(depth)
+            continue
+        if tag is _UNBIND:
+            depth -= 1
+            scope[node[1]].pop()
+            continue
+
+        if limit is not None and len(out) > limit:
+            return None
+
+        if id(node) in _literals:
+            pos = first.get(id(node))
+            if pos is not None:
+                out += ("ref", pos)
+                continue
+            first[id(node)] = len(out)
+
+        out.append(tag)
+        if tag == "var":
+            depths = scope.get(node[1])
+            out.append(depth - depths[-1] if depths else node[1])
+        elif tag == "num":
+            out += (node[1], math.copysign(1.0, node[1]))
+        elif tag == "lam":
+            work += ((_UNBIND, node[1]), node[2], (_BIND, node[1]))
+        elif tag == "let":
+            work += ((_UNBIND, node[1]), node[3], (_BIND, node[1]), node[2])
+        elif tag == "letrec":
+            work += ((_UNBIND, node[1]), node[3], node[2], (_BIND, node[1]))
+        elif tag == "list":
+            out.append(node[4] - node[3])
+            work.append(node[1])
+            work += reversed(node[2][node[3]:node[4]])
+        else:
+            work += reversed(node[1:])
+
+    return tuple(out)
+
+
+class LoopDetector:
+    """
+    Brent's cycle detection over the states handed to repeats(); interval
+    is the number of steps until the next one is due.
+    """
+
+    __slots__ = ("saved", "power", "count", "interval")
+
+    def __init__(self):
+        self.saved = None
+        self.power = 1
+        self.count = 0
+        self.interval = LOOP_CHECK_EVERY
+
+    def repeats(self, t):
+        """Whether t is alpha-equivalent to the saved state"""
+        key = alpha_key(t, KEY_LIMIT)
+        if key is None:
+            self.interval = KEY_LIMIT // 2
+            return False
+        self.interval = max(LOOP_CHECK_EVERY, len(key) // 2)
+        if key == self.saved:
+            return True
+        # save the state at every power of two, so a cycle is found
+        # within two of its lengths once it has started
+        self.count += 1
+        if self.count >= self.power:
+            self.saved = key
+            self.power *= 2
+            self.count = 0
+        return False
+
+
+def evaluate_iter(t, max_steps=MAX_STEPS, every=1, cap=None, events=False, stats=None):
+    """
+    Reduce t like evaluate(), yielding (n, term) for the term after every
+    every-th reduction, n being the reductions so far: (0, t) first and
+    the value last. every=None yields only the value. With events=True it
+    yields (n, redex) instead, the node whose rule the n-th reduction
+    fired, and not the terms. Stops after cap items. Returns the value
+    (None when stopped by cap); raises RuntimeError like evaluate().
+    Only what is yielded is kept, with its lists unpacked.
+
+    stats, if given, is told what happens: stats.start(t) first, then
+    stats.fired(redex, reduct) for every reduction, and its
+    substitute_calls, nodes_copied, free_vars_calls and fresh_names are
+    incremented (see stats.Stats).
+    """
+    if stats is not None:
+        stats.start(t)
+    focus = _Focus(t, stats)
+    loops = LoopDetector()
+    check = 0
+    sample = every is not None
+    yielded = 0
+    n = 0
+    while True:
+        if n == check:
+            if loops.repeats(focus.term()):
+                raise RuntimeError("non-terminating")
+            check += loops.interval
+        if sample and not events and n % every == 0:
+            yield n, unpack(focus.term())
+            yielded += 1
+            if yielded == cap:
+                return None
+        if n >= max_steps:
+            # still reducible but hit step limit
+            raise RuntimeError("non-terminating")
+
+        if not focus.step():
+            break
+        n += 1
+        if sample and events and n % every == 0:
+            yield n, unpack(last_redex)
+            yielded += 1
+            if yielded == cap:
+                return None
+
+    value = unpack(focus.term())
+    if not events and not (sample and n % every == 0):
+        yield n, value
+    return value
+
+
+def evaluate(t, max_steps=MAX_STEPS, limits=None, stats=None):
+    """
+    Reduce t to a value. Raises RuntimeError after max_steps reductions
+    or once a state repeats, or LimitExceeded when limits (which then
+    replace max_steps) trip. stats counts as in evaluate_iter.
+    """
+    if limits is not None:
+        return _evaluate_limited(t, limits, stats)[0]
+    for _, t in evaluate_iter(t, max_steps, every=None, stats=stats):
+        pass
+    return t
+
+
+# --------------------------------------------------------------------
+# Resource limits
+# --------------------------------------------------------------------
 
-def evaluate(t):
-    changed = True
+# steps between two checks of the clock, the cancel flag, memory and the
+# term size; a check costs at most the size limit in nodes visited
+CHECK_EVERY = 128
+
+
+class Limits:
+    """
+    Bounds for one evaluate() call; None leaves a bound off. seconds is
+    wall-clock time, size the number of nodes of the term (counted as a
+    tree), memory_mb the resident size of the process, and cancel anything
+    with is_set(), e.g. a threading.Event set from another thread. All but
+    steps are checked every CHECK_EVERY steps.
+    """
+
+    def __init__(self, steps=MAX_STEPS, seconds=None, size=None, memory_mb=None, cancel=None):
+        self.steps = steps
+        self.seconds = seconds
+        self.size = size
+        self.memory_mb = memory_mb
+        self.cancel = cancel
+
+
+class LimitExceeded(RuntimeError):
+    """
+    Evaluation stopped by Limits. limit is "steps", "time", "size",
+    "memory", "cancelled", or "loop" when a state repeated; steps and
+    seconds are how far it got, and term is where it stopped.
+    """
+
+    def __init__(self, limit, steps, seconds, term):
+        super().__init__(f"{limit} limit exceeded after {steps} steps")
+        self.limit = limit
+        self.steps = steps
+        self.seconds = seconds
+        self.term = term
+
+
+def term_size(t, stop=None):
+    """Nodes in t counted as a tree; counting ends once it passes stop"""
+    n = 0
+    work = [t]
+    while work:
+        node = work.pop()
+        n += 1
+        if node[0] == "list":
+            # as many nodes as its cons cells
+            n += node[4] - node[3] - 1
+            work += node[2][node[3]:node[4]]
+        if stop is not None and n > stop:
+            break
+        for x in node[1:]:
+            if type(x) is tuple:
+                work.append(x)
+    return n
+
+
+def _resident_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        # no /proc: the peak instead, in KiB on Linux and bytes on macOS
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def _tripped(limits, t, deadline):
+    """Name of the first limit other than steps that t has passed, or None"""
+    if limits.cancel is not None and limits.cancel.is_set():
+        return "cancelled"
+    if deadline is not None and time.monotonic() > deadline:
+        return "time"
+    if limits.memory_mb is not None and _resident_mb() > limits.memory_mb:
+        return "memory"
+    if limits.size is not None and term_size(t, limits.size) > limits.size:
+        return "size"
+    return None
+
+
+def _evaluate_limited(t, limits, stats=None):
+    """evaluate() under limits: (value, steps taken)"""
+    if stats is not None:
+        stats.start(t)
+    focus = _Focus(t, stats)
+    start = time.monotonic()
+    deadline = None if limits.seconds is None else start + limits.seconds
+    max_steps = MAX_STEPS if limits.steps is None else limits.steps
+    loops = LoopDetector()
+    check = 0
     steps = 0
-    while changed and steps < MAX_STEPS:
-        t, changed = step(t)
+    while True:
+        if steps % CHECK_EVERY == 0:
+            t = focus.term()
+            limit = _tripped(limits, t, deadline)
+            if limit is not None:
+                raise LimitExceeded(limit, steps, time.monotonic() - start, unpack(t))
+        if steps == check:
+            t = focus.term()
+            if loops.repeats(t):
+                raise LimitExceeded("loop", steps, time.monotonic() - start, unpack(t))
+            check += loops.interval
+        if steps >= max_steps:
+            raise LimitExceeded("steps", steps, time.monotonic() - start, unpack(focus.term()))
+        if not focus.step():
+            return unpack(focus.term()), steps
         steps += 1
-    if changed:
-        # still reducible but hit step limit
-        raise RuntimeError("non-terminating")
-    return t
 
 
 # --------------------------------------------------------------------
 # Top-level interface
 # --------------------------------------------------------------------
 
-def interpret(src: str) -> str:
-    cst = parser.parse(src)
+# Evaluator backends: name -> (module, function). Every backend maps a tuple
+# AST and a step budget to a tuple AST and raises RuntimeError when it gives
+# up.
+BACKENDS = {
+    "rewrite": ("interpreter", "evaluate"),
+    "cek": ("machine", "evaluate"),
+    "need": ("machine", "evaluate_need"),
+    "vm": ("vm", "evaluate"),
+    "closures": ("closures", "evaluate"),
+    "transpile": ("transpile", "evaluate"),
+}
+
+# Backends that can also start from the program text, so that a cached
+# compiled program does not need the parser: name -> (module, function)
+SOURCE_BACKENDS = {
+    "transpile": ("transpile", "evaluate_source"),
+}
+
+
+def get_backend(name, table=BACKENDS):
+    if name not in table:
+        raise ValueError(f"unknown backend: {name}")
+    module_name, func_name = table[name]
+    if module_name == "interpreter":
+        return globals()[func_name]
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def interpret(src: str, backend: str = "rewrite", passes=None, max_steps=MAX_STEPS) -> str:
+    """
+    Evaluate program text and print the result. passes names the
+    optimize.py passes to run on the AST first; None runs none.
+    """
+    ng.reset()
+    if backend in SOURCE_BACKENDS and passes is None:
+        try:
+            out = get_backend(backend, SOURCE_BACKENDS)(src, max_steps)
+            return linearize(out, top=True)
+        except RuntimeError:
+            return NON_TERMINATING
+
+    cst = get_parser().parse(src)
     ast = LambdaCalculusTransformer().transform(cst)
+    if passes is not None:
+        from optimize import optimize
+        ast, _ = optimize(ast, passes)
     try:
-        out = evaluate(ast)
+        out = get_backend(backend)(ast, max_steps)
         return linearize(out, top=True)
     except RuntimeError:
-        return "<non-terminating>"
+        return NON_TERMINATING
+
+
+# output is the printed value, or None when evaluation stopped; then limit
+# names the bound that stopped it. steps and seconds are how far it got.
+Report = collections.namedtuple("Report", "output limit steps seconds")
+
+
+def interpret_limited(src, limits, passes=None):
+    """interpret() on the rewrite backend under limits, as a Report"""
+    ng.reset()
+    cst = get_parser().parse(src)
+    ast = LambdaCalculusTransformer().transform(cst)
+    if passes is not None:
+        from optimize import optimize
+        ast, _ = optimize(ast, passes)
+    start = time.monotonic()
+    try:
+        out, steps = _evaluate_limited(ast, limits)
+    except LimitExceeded as e:
+        return Report(None, e.limit, e.steps, e.seconds)
+    return Report(linearize(out, top=True), None, steps, time.monotonic() - start)
+
+
+def show_report(report):
+    """What interpret() would print for a Report"""
+    if report.limit is None:
+        return report.output
+    if report.limit in ("steps", "loop"):
+        return NON_TERMINATING
+    return f"<limit exceeded: {report.limit} after {report.steps} steps>"
+
+
+# --------------------------------------------------------------------
+# Streaming
+# --------------------------------------------------------------------
+
+def stream(inp, out, run=interpret, **options):
+    """streaming.stream with interpret() as the default run"""
+    streaming.stream(inp, out, run, **options)
 
 
 def main():
-    if len(sys.argv) != 2:
-        print('usage: interpreter.py "<expr>" or interpreter.py file.lc')
-        sys.exit(1)
+    ap = argparse.ArgumentParser(
+        usage='interpreter.py "<expr>" or interpreter.py file.lc or interpreter.py --stream'
+    )
+    ap.add_argument("program", nargs="?", help="expression or path to a .lc file")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default="rewrite")
+    ap.add_argument(
+        "--max-steps", type=int, default=MAX_STEPS,
+        help="reductions before giving up as non-terminating",
+    )
+    ap.add_argument(
+        "-O", "--optimize", nargs="?", const="all", metavar="PASSES",
+        help="optimize first: all passes, or a comma-separated list",
+    )
+    ap.add_argument(
+        "--cache", action="store_true",
+        help="reuse the result of an earlier run of the same program",
+    )
+    ap.add_argument(
+        "--batch", action="store_true",
+        help="program is a file with one program per line; print one result per line",
+    )
+    ap.add_argument(
+        "--workers", type=int, default=None,
+        help="worker processes for --batch (default: one per CPU)",
+    )
+    ap.add_argument(
+        "--stream", action="store_true",
+        help="read programs from stdin, one per line, and print each result as it finishes",
+    )
+    ap.add_argument(
+        "-z", "--null", action="store_true",
+        help="with --stream: programs are separated by NUL bytes instead of newlines",
+    )
+    ap.add_argument(
+        "--json", action="store_true",
+        help="with --stream: print JSON lines with the result and the time taken",
+    )
+    ap.add_argument(
+        "--line-buffered", action="store_true",
+        help="with --stream: flush after every result",
+    )
+    ap.add_argument(
+        "--timeout", type=float, default=None, metavar="SECONDS",
+        help="give up after this much wall-clock time (rewrite backend)",
+    )
+    ap.add_argument(
+        "--max-size", type=int, default=None, metavar="NODES",
+        help="give up once the term grows past this many nodes (rewrite backend)",
+    )
+    ap.add_argument(
+        "--max-memory", type=float, default=None, metavar="MB",
+        help="give up once the process uses this much memory (rewrite backend)",
+    )
+    ap.add_argument(
+        "--stats", action="store_true",
+        help="print reduction counters as JSON on stderr (rewrite backend)",
+    )
+    args = ap.parse_args()
+    if args.program is None and not args.stream:
+        ap.error("a program is required unless --stream is given")
+    if args.stream and args.batch:
+        ap.error("--stream and --batch cannot be combined")
+    limited = (args.timeout, args.max_size, args.max_memory) != (None, None, None)
+    if limited and (args.backend != "rewrite" or args.cache or args.batch):
+        ap.error("--timeout, --max-size and --max-memory need the rewrite backend, "
+                 "without --cache or --batch")
+    if args.stats and (args.backend != "rewrite" or args.cache or args.batch or args.stream):
+        ap.error("--stats needs the rewrite backend, without --cache, --batch or --stream")
+
+    passes = None
+    if args.optimize == "all":
+        passes = list(importlib.import_module("optimize").PASSES)
+    elif args.optimize:
+        passes = args.optimize.split(",")
+
+    run = interpret
+    if args.cache:
+        from result_cache import ResultCache
+        run = ResultCache().interpret
+    if limited:
+        def run(src, backend, passes, max_steps):
+            limits = Limits(max_steps, args.timeout, args.max_size, args.max_memory)
+            return show_report(interpret_limited(src, limits, passes))
+
+    if args.stream:
+        stream(
+            sys.stdin.buffer, sys.stdout, run=run, sep=b"\0" if args.null else b"\n",
+            as_json=args.json, line_buffered=args.line_buffered,
+            backend=args.backend, passes=passes, max_steps=args.max_steps,
+        )
+        return
+
+    arg = args.program
+    if args.batch:
+        from batch import interpret_many, ERROR
+        with open(arg) as f:
+            sources = [line for line in f.read().splitlines() if line.strip()]
+        outcomes = interpret_many(
+            sources, workers=args.workers, backend=args.backend, passes=passes,
+            max_steps=args.max_steps,
+        )
+        for outcome in outcomes:
+            if outcome.status == ERROR:
+                print(f"<error: {outcome.error.splitlines()[0]}>")
+            else:
+                print(outcome.output)
+        return
 
-    arg = sys.argv[1]
     if os.path.isfile(arg):
         src = open(arg).read()
     else:
         src = arg
 
-    print(interpret(src))
+    if args.stats:
+        import stats
+        limits = None
+        if limited:
+            limits = Limits(args.max_steps, args.timeout, args.max_size, args.max_memory)
+        output, counters = stats.run(src, passes, args.max_steps, limits)
+        print(output)
+        print(counters.to_json(), file=sys.stderr)
+        return
+
+    print(run(src, backend=args.backend, passes=passes, max_steps=args.max_steps))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,490 @@
+"""
+machine.py
+
+Environment/continuation (CEK) evaluator for the PA3 language.
+
+Instead of rewriting the whole term with step() until nothing changes, the
+machine keeps the term fixed and evaluates it against an environment of
+closures, with an explicit continuation stack in place of Python recursion.
+It runs on the de Bruijn form from debruijn.py, so a variable is found by
+its index and no reduction needs free_vars or renaming. Every reduction is
+O(1) apart from the index walk, and the run time is linear in the number of
+reductions.
+
+Arguments and let-bound values are passed as thunks. By default they are
+re-evaluated at every use (call-by-name, like substitution). With lazy=True
+each thunk is evaluated at most once and the value is shared by every use
+(call-by-need); residual terms then show a forced argument as its value.
+
+Tail calls do not grow the continuation, and cheap arithmetic arguments of
+calls inside lambda bodies are computed up front (see speculate), so a
+letrec loop with a counter and an accumulator runs in constant stack and
+takes constant time per iteration. A
+letrec-bound lambda is a closure over an environment that contains itself
+(see RecThunk), so recursion never re-expands fix.
+
+The results are the same terms the rewriting evaluator produces: whatever is
+left unevaluated (lambda bodies, untaken branches, unforced arguments) is
+read back into a tuple term by substituting the environment into it.
+"""
+
+from interpreter import MAX_STEPS, free_vars, substitute, ng
+from debruijn import CHEAP_SIZE, cheap, compile_term, decompile, env_refs, mark_tail_calls
+
+
+# --------------------------------------------------------------------
+# Runtime values
+#
+#   float    numbers
+#   NIL      the empty list
+#   Cons     evaluated list cell
+#   Closure  compiled lambda + environment
+#   Neutral  stuck term (free variable, ill-typed operation, ...), already
+#            read back into a named tuple term
+#
+# Environments are linked tuples (name, thunk, parent) or None, indexed by
+# de Bruijn index; the name is kept for read back.
+# --------------------------------------------------------------------
+
+class Nil:
+    __slots__ = ()
+
+
+NIL = Nil()
+
+
+class Cons:
+    __slots__ = ("head", "tail")
+
+    def __init__(self, head, tail):
+        self.head = head
+        self.tail = tail
+
+
+class Closure:
+    __slots__ = ("term", "env")
+
+    def __init__(self, term, env):
+        self.term = term
+        self.env = env
+
+
+class Neutral:
+    __slots__ = ("term",)
+
+    def __init__(self, term):
+        self.term = term
+
+
+class Thunk:
+    """Delayed argument. Under call-by-need, value caches the first result."""
+    __slots__ = ("term", "env", "value")
+
+    def __init__(self, term, env):
+        self.term = term
+        self.env = env
+        self.value = None
+
+
+class Speculated(Thunk):
+    """
+    Argument whose value was computed up front (see speculate). It keeps
+    its term and environment, and reads back as the term, as it would if
+    it had been passed unevaluated.
+    """
+    __slots__ = ()
+
+    def __init__(self, term, env, value):
+        self.term = term
+        self.env = env
+        self.value = value
+
+
+class RecThunk(Thunk):
+    """
+    What letrec binds its name to. When the bound value is a lambda, value
+    holds its closure, whose environment holds this thunk again: the knot
+    is tied, and a recursive call is a lookup instead of another fix
+    unfolding. It reads back as the fix term, not through the cycle.
+    """
+    __slots__ = ()
+
+
+def lookup(env, k):
+    while k:
+        env = env[2]
+        k -= 1
+    return env
+
+
+def evaluated(v):
+    """A thunk that already holds the number v"""
+    th = Thunk(("num", v), None)
+    th.value = v
+    return th
+
+
+def delay(t, env):
+    """Thunk for an argument; a bound variable passes its own thunk along"""
+    if t[0] == "bvar":
+        return lookup(env, t[1])[1]
+    if t[0] == "num":
+        return evaluated(t[1])
+    return Thunk(t, env)
+
+
+def speculate(t, env):
+    """
+    Value of the argument t, which must pass debruijn.cheap, if everything
+    it refers to is (or is a small arithmetic thunk over) a number, else
+    None. Every backend decides what to speculate with cheap(); the thunks
+    looked into may add as many nodes again as t has.
+
+    Arguments of calls inside lambda bodies (tapp / sapp) are speculated so
+    that a loop counter or an accumulator is read as a number instead of by
+    re-evaluating the previous calls' thunks: a tail-recursive loop then
+    takes constant time per call, and a non-tail recursion does not
+    re-evaluate a chain of n - 1 thunks at every level. The arithmetic
+    always terminates, so this cannot change the result; the caller wraps
+    the value in a Speculated thunk, which still reads back as t.
+    """
+    budget = [2 * CHEAP_SIZE]
+    return _arith(t, env, budget)
+
+
+def _arith(t, env, budget):
+    budget[0] -= 1
+    if budget[0] < 0:
+        return None
+    tag = t[0]
+
+    if tag == "num":
+        return t[1]
+    if tag == "bvar":
+        th = lookup(env, t[1])[1]
+        if th.value is None:
+            return _arith(th.term, th.env, budget)
+        return th.value if type(th.value) is float else None
+    if tag not in ("plus", "minus", "times", "neg"):
+        return None
+
+    left = _arith(t[1], env, budget)
+    if left is None:
+        return None
+    if tag == "neg":
+        return -left
+    right = _arith(t[2], env, budget)
+    if right is None:
+        return None
+    if tag == "plus":
+        return left + right
+    if tag == "minus":
+        return left - right
+    return left * right
+
+
+# --------------------------------------------------------------------
+# Read back
+# --------------------------------------------------------------------
+
+def subst_many(t, sub):
+    """Simultaneous capture-avoiding substitution of sub = {name: term}"""
+    if not sub:
+        return t
+    clash = set()
+    for rep in sub.values():
+        clash |= free_vars(rep)
+    if clash & sub.keys():
+        # A replacement mentions one of the names being replaced, so going
+        # one name at a time would substitute into it. Park every name on a
+        # fresh placeholder first.
+        parked = {}
+        for name, rep in sub.items():
+            tmp = ng.fresh(free_vars(t) | clash | sub.keys())
+            t = substitute(t, name, ("var", tmp))
+            parked[tmp] = rep
+        sub = parked
+    for name, rep in sub.items():
+        t = substitute(t, name, rep)
+    return t
+
+
+def close_term(t, env):
+    """Read back compiled t, substituting the environment it refers to"""
+    sub = {}
+    for k in env_refs(t):
+        entry = lookup(env, k)
+        sub[entry[0]] = reify(entry[1])
+    return subst_many(decompile(t), sub)
+
+
+def reify(v):
+    """Turn a runtime value (or thunk) back into a tuple term"""
+    heads = []
+    while isinstance(v, Cons):
+        heads.append(v.head)
+        v = v.tail
+
+    if isinstance(v, float):
+        out = ("num", v)
+    elif v is NIL:
+        out = ("nil",)
+    elif isinstance(v, Neutral):
+        out = v.term
+    elif isinstance(v, (RecThunk, Speculated)):
+        out = close_term(v.term, v.env)
+    elif isinstance(v, Thunk) and v.value is not None:
+        out = reify(v.value)
+    else:
+        # Closure or Thunk
+        out = close_term(v.term, v.env)
+
+    for h in reversed(heads):
+        out = ("cons", reify(h), out)
+    return out
+
+
+def values_equal(v1, v2):
+    """Structural equality on runtime values, as in interpreter.values_equal"""
+    while isinstance(v1, Cons) and isinstance(v2, Cons):
+        if not values_equal(v1.head, v2.head):
+            return False
+        v1, v2 = v1.tail, v2.tail
+    if isinstance(v1, float) and isinstance(v2, float):
+        return v1 == v2
+    return v1 is NIL and v2 is NIL
+
+
+# --------------------------------------------------------------------
+# The machine
+# --------------------------------------------------------------------
+
+# continuation frames, tagged by their first element
+ARG = "arg"            # (ARG, arg_term, env, spec)  waiting for the function
+STUCK_APP = "stuck"    # (STUCK_APP, fn_value)       waiting for the argument
+BIN_L = "bin_l"        # (BIN_L, op, right, env)     waiting for the left side
+BIN_R = "bin_r"        # (BIN_R, op, left_value)     waiting for the right side
+UNARY = "unary"        # (UNARY, op)                 neg / hd / tl
+IF = "if"              # (IF, if_term, env)          waiting for the condition
+FIX = "fix"            # (FIX,)                      waiting for the function
+CONS_H = "cons_h"      # (CONS_H, tail, env)         waiting for the head
+CONS_T = "cons_t"      # (CONS_T, head_value)        waiting for the tail
+PROG_L = "prog_l"      # (PROG_L, right, env)
+PROG_R = "prog_r"      # (PROG_R, left_value)
+UPDATE = "update"      # (UPDATE, thunk)             call-by-need memo
+
+
+def run(t, env=None, max_steps=MAX_STEPS, lazy=False):
+    """Evaluate compiled t in env to a runtime value"""
+    kont = []
+    steps = 0
+    v = None
+
+    while True:
+        if t is not None:
+            # ---- eval: look at the control term ----
+            tag = t[0]
+
+            if tag == "num":
+                v, t = t[1], None
+
+            elif tag == "bvar":
+                th = lookup(env, t[1])[1]
+                if th.value is not None:
+                    v, t = th.value, None
+                elif not lazy:
+                    # call-by-name: re-evaluate the argument where it was made
+                    t, env = th.term, th.env
+                else:
+                    # call-by-need: evaluate once, remember the value
+                    kont.append((UPDATE, th))
+                    t, env = th.term, th.env
+
+            elif tag == "lam":
+                v, t = Closure(t, env), None
+
+            elif tag in ("app", "tapp", "sapp"):
+                # the continuation does not grow on a tail call anyway; tapp
+                # and sapp only ask for the argument to be speculated
+                kont.append((ARG, t[2], env, tag != "app"))
+                t = t[1]
+
+            elif tag in ("plus", "minus", "times", "eq", "leq"):
+                kont.append((BIN_L, tag, t[2], env))
+                t = t[1]
+
+            elif tag in ("neg", "hd", "tl"):
+                kont.append((UNARY, tag))
+                t = t[1]
+
+            elif tag == "if":
+                kont.append((IF, t, env))
+                t = t[1]
+
+            elif tag == "let":
+                # let x = e1 in e2  -->  (\x.e2) e1
+                steps += 1
+                env = (t[1], delay(t[2], env), env)
+                t = t[3]
+
+            elif tag == "letrec":
+                # letrec f = e1 in e2  -->  let f = (fix (\f.e1)) in e2,
+                # with f bound to its own closure when e1 is a lambda
+                steps += 1
+                th = RecThunk(t[2], env)
+                env = (t[1], th, env)
+                value = t[2][1][2]
+                if value[0] == "lam":
+                    th.value = Closure(value, env)
+                t = t[3]
+
+            elif tag == "fix":
+                kont.append((FIX,))
+                t = t[1]
+
+            elif tag == "nil":
+                v, t = NIL, None
+
+            elif tag == "cons":
+                kont.append((CONS_H, t[2], env))
+                t = t[1]
+
+            elif tag == "prog":
+                kont.append((PROG_L, t[2], env))
+                t = t[1]
+
+            elif tag == "free":
+                v, t = Neutral(("var", t[1])), None
+
+            else:
+                v, t = Neutral(decompile(t)), None
+
+            continue
+
+        # ---- apply: hand the value v to the innermost frame ----
+        if not kont:
+            return v
+
+        if steps > max_steps:
+            raise RuntimeError("non-terminating")
+
+        frame = kont.pop()
+        kind = frame[0]
+
+        if kind is ARG:
+            if isinstance(v, Closure):
+                # beta: bind the unevaluated argument
+                steps += 1
+                lam = v.term
+                arg = frame[1]
+                th = None
+                if frame[3] and cheap(arg):
+                    n = speculate(arg, frame[2])
+                    if n is not None:
+                        th = Speculated(arg, frame[2], n)
+                if th is None:
+                    th = delay(arg, frame[2])
+                env = (lam[1], th, v.env)
+                t = lam[2]
+            else:
+                kont.append((STUCK_APP, v))
+                t, env = frame[1], frame[2]
+
+        elif kind is STUCK_APP:
+            v = Neutral(("app", reify(frame[1]), reify(v)))
+
+        elif kind is BIN_L:
+            kont.append((BIN_R, frame[1], v))
+            t, env = frame[2], frame[3]
+
+        elif kind is BIN_R:
+            op, left = frame[1], frame[2]
+            nums = isinstance(left, float) and isinstance(v, float)
+            if op == "eq":
+                steps += 1
+                v = 1.0 if values_equal(left, v) else 0.0
+            elif not nums:
+                v = Neutral((op, reify(left), reify(v)))
+            elif op == "plus":
+                steps += 1
+                v = left + v
+            elif op == "minus":
+                steps += 1
+                v = left - v
+            elif op == "times":
+                steps += 1
+                v = left * v
+            else:  # leq
+                steps += 1
+                v = 1.0 if left <= v else 0.0
+
+        elif kind is UNARY:
+            op = frame[1]
+            if op == "neg" and isinstance(v, float):
+                steps += 1
+                v = -v
+            elif op == "hd" and isinstance(v, Cons):
+                steps += 1
+                v = v.head
+            elif op == "tl" and isinstance(v, Cons):
+                steps += 1
+                v = v.tail
+            else:
+                v = Neutral((op, reify(v)))
+
+        elif kind is IF:
+            node, if_env = frame[1], frame[2]
+            if isinstance(v, float) and v == 1.0:
+                steps += 1
+                t, env = node[2], if_env
+            elif isinstance(v, float) and v == 0.0:
+                steps += 1
+                t, env = node[3], if_env
+            else:
+                v = Neutral((
+                    "if",
+                    reify(v),
+                    close_term(node[2], if_env),
+                    close_term(node[3], if_env),
+                ))
+
+        elif kind is FIX:
+            if isinstance(v, Closure):
+                # fix F  -->  F (fix F)
+                steps += 1
+                lam = v.term
+                again = RecThunk(("fix", lam), v.env)
+                env = (lam[1], again, v.env)
+                if lam[2][0] == "lam":
+                    again.value = v = Closure(lam[2], env)
+                else:
+                    t = lam[2]
+            else:
+                v = Neutral(("fix", reify(v)))
+
+        elif kind is CONS_H:
+            kont.append((CONS_T, v))
+            t, env = frame[1], frame[2]
+
+        elif kind is CONS_T:
+            v = Cons(frame[1], v)
+
+        elif kind is PROG_L:
+            kont.append((PROG_R, v))
+            t, env = frame[1], frame[2]
+
+        elif kind is PROG_R:
+            v = Neutral(("prog", reify(frame[1]), reify(v)))
+
+        elif kind is UPDATE:
+            frame[1].value = v
+
+
+def evaluate(t, max_steps=MAX_STEPS):
+    """Drop-in replacement for interpreter.evaluate"""
+    return reify(run(mark_tail_calls(compile_term(t)), max_steps=max_steps))
+
+
+def evaluate_need(t, max_steps=MAX_STEPS):
+    """Call-by-need variant of evaluate: arguments are shared, not copied"""
+    return reify(run(mark_tail_calls(compile_term(t)), max_steps=max_steps, lazy=True))
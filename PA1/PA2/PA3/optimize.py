@@ -0,0 +1,241 @@
+"""
+optimize.py
+
+Optimization passes run on the tuple AST before it is evaluated.
+
+    fold     constant folding: arithmetic, neg, == and <= on literals, and
+             if on a literal 1 or 0
+    inline   let x = v in b  -->  b[v/x], when v is atomic (number, variable,
+             nil), a small lambda, or used once outside any lambda
+    beta     (\\x.b) a  -->  b[a/x], under the same conditions as inline
+    dead     let / letrec bindings whose name is not used in the body
+
+Every pass does a rewrite the evaluators would do anyway: call-by-name makes
+inlining and dropping an unused binding safe even when its value does not
+terminate. The restrictions on inline and beta only keep the term from
+growing and keep call-by-need from evaluating a shared value more than once.
+Since the passes also rewrite under lambdas, a residual lambda prints in its
+optimized form.
+
+optimize() runs the enabled passes until nothing changes and reports, for
+each pass, the size of the terms it rewrote before and after. Inlining a
+lambda at several uses can make the term bigger, so after may exceed before.
+"""
+
+from interpreter import mk, substitute, free_vars, values_equal
+
+
+# lambdas up to this many nodes are inlined at every use
+INLINE_SIZE = 8
+
+# pipeline rounds before giving up on a fixed point
+MAX_ROUNDS = 10
+
+
+def size(t):
+    """Number of nodes in t"""
+    n = 0
+    work = [t]
+    while work:
+        t = work.pop()
+        n += 1
+        work += _kids(t)
+    return n
+
+
+def _kids(t):
+    tag = t[0]
+    if tag in ("var", "num", "nil"):
+        return ()
+    if tag == "lam":
+        return (t[2],)
+    if tag in ("let", "letrec"):
+        return (t[2], t[3])
+    return t[1:]
+
+
+def rewrite(t, fn):
+    """Rebuild t bottom-up, replacing every node u by fn(u)"""
+    out = []
+    work = [(t, False)]
+
+    while work:
+        node, done = work.pop()
+        tag = node[0]
+
+        if not done:
+            kids = _kids(node)
+            if not kids:
+                out.append(fn(node))
+            else:
+                work.append((node, True))
+                work += [(k, False) for k in reversed(kids)]
+            continue
+
+        if tag == "lam":
+            body = out.pop()
+            new = node if body is node[2] else mk("lam", node[1], body)
+        elif tag in ("let", "letrec"):
+            body = out.pop()
+            value = out.pop()
+            if value is node[2] and body is node[3]:
+                new = node
+            else:
+                new = mk(tag, node[1], value, body)
+        else:
+            n = len(node) - 1
+            kids = out[-n:]
+            del out[-n:]
+            if all(k is o for k, o in zip(kids, node[1:])):
+                new = node
+            else:
+                new = mk(tag, *kids)
+        out.append(fn(new))
+
+    return out[0]
+
+
+def uses(t, name):
+    """(occurrences of free name in t, whether any is inside a lambda)"""
+    count = 0
+    under_lam = False
+    work = [(t, False)]
+
+    while work:
+        t, lam = work.pop()
+        tag = t[0]
+
+        if tag == "var":
+            if t[1] == name:
+                count += 1
+                under_lam = under_lam or lam
+        elif tag == "lam":
+            if t[1] != name:
+                work.append((t[2], True))
+        elif tag == "let":
+            work.append((t[2], lam))
+            if t[1] != name:
+                work.append((t[3], lam))
+        elif tag == "letrec":
+            if t[1] != name:
+                # the value is entered again on every recursive call
+                work.append((t[2], True))
+                work.append((t[3], lam))
+        elif tag not in ("num", "nil"):
+            work += [(k, lam) for k in t[1:]]
+
+    return count, under_lam
+
+
+def _literal(t):
+    """Closed data: numbers, nil and cons cells of those"""
+    while t[0] == "cons":
+        if not _literal(t[1]):
+            return False
+        t = t[2]
+    return t[0] in ("num", "nil")
+
+
+def _inlinable(value, body, name):
+    if value[0] in ("num", "var", "nil"):
+        return True
+    if value[0] == "lam" and size(value) <= INLINE_SIZE:
+        return True
+    count, under_lam = uses(body, name)
+    return count == 1 and not under_lam
+
+
+# --------------------------------------------------------------------
+# Passes: node -> node, applied bottom-up by rewrite()
+# --------------------------------------------------------------------
+
+def fold(t):
+    tag = t[0]
+
+    if tag in ("plus", "minus", "times", "leq"):
+        left, right = t[1], t[2]
+        if left[0] == "num" and right[0] == "num":
+            lv, rv = left[1], right[1]
+            if tag == "plus":
+                return mk("num", float(lv + rv))
+            if tag == "minus":
+                return mk("num", float(lv - rv))
+            if tag == "times":
+                return mk("num", float(lv * rv))
+            return mk("num", 1.0 if lv <= rv else 0.0)
+
+    elif tag == "neg":
+        if t[1][0] == "num":
+            return mk("num", float(-t[1][1]))
+
+    elif tag == "eq":
+        if _literal(t[1]) and _literal(t[2]):
+            return mk("num", 1.0 if values_equal(t[1], t[2]) else 0.0)
+
+    elif tag == "if":
+        cond = t[1]
+        if cond[0] == "num" and cond[1] == 1.0:
+            return t[2]
+        if cond[0] == "num" and cond[1] == 0.0:
+            return t[3]
+
+    return t
+
+
+def inline(t):
+    if t[0] == "let" and _inlinable(t[2], t[3], t[1]):
+        return substitute(t[3], t[1], t[2])
+    return t
+
+
+def beta(t):
+    if t[0] == "app" and t[1][0] == "lam":
+        lam, arg = t[1], t[2]
+        if _inlinable(arg, lam[2], lam[1]):
+            return substitute(lam[2], lam[1], arg)
+    return t
+
+
+def dead(t):
+    if t[0] in ("let", "letrec") and t[1] not in free_vars(t[3]):
+        return t[3]
+    return t
+
+
+PASSES = {
+    "fold": fold,
+    "inline": inline,
+    "beta": beta,
+    "dead": dead,
+}
+
+
+def optimize(t, passes=None):
+    """
+    Run the named passes (default: all, in PASSES order) to a fixed point.
+    Returns the optimized term and {pass name: (before, after)}: the nodes
+    in the terms the pass changed, summed over the rounds, before and after
+    it ran.
+    """
+    names = list(PASSES) if passes is None else list(passes)
+    for name in names:
+        if name not in PASSES:
+            raise ValueError(f"unknown optimization pass: {name}")
+
+    sizes = {name: (0, 0) for name in names}
+    n = size(t)
+
+    for _ in range(MAX_ROUNDS):
+        changed = False
+        for name in names:
+            new = rewrite(t, PASSES[name])
+            if new is not t:
+                changed = True
+                m = size(new)
+                before, after = sizes[name]
+                sizes[name] = (before + n, after + m)
+                t, n = new, m
+        if not changed:
+            break
+
+    return t, sizes
@@ -0,0 +1,217 @@
+"""
+result_cache.py
+
+Optional cache of interpret() results.
+
+interpret() is a pure function of the program text, its arguments and the
+interpreter's own code (it restarts the fresh-name counter, so even renamed
+variables come out the same), so a result can be reused by any later call
+with the same inputs. ResultCache keeps an in-process LRU in front of an SQLite file
+in CACHE_DIR. Both are keyed by a hash of
+
+    the program text, with comments dropped and whitespace collapsed
+    backend, optimization passes and step limit
+    grammar.lark and the interpreter's .py files
+
+so editing the interpreter never serves stale results. "<non-terminating>"
+is cached like any other result, so a known-divergent program costs a lookup
+instead of max_steps reductions. Programs that fail to parse raise as usual
+and are not cached.
+
+Both levels are bounded: the LRU by lru_size entries, the file by
+max_entries rows, evicting the least recently used. The row count is kept
+in memory, counted once when the file is opened, so with several processes
+sharing one file the bound is approximate. A disk hit marks its row as used
+in memory; the marks are written with the next put(), every TOUCH_BATCH hits
+and on close(), so a hit costs one SELECT. A cache directory that cannot be
+written only costs speed.
+
+    python3 interpreter.py --cache "<expr>"
+"""
+
+import collections
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+import interpreter
+from interpreter import MAX_STEPS, CACHE_DIR, GRAMMAR_PATH
+
+
+LRU_SIZE = 1024
+MAX_ENTRIES = 100000
+TOUCH_BATCH = 64         # disk hits whose last-used times are written at once
+
+DEFAULT_PATH = os.path.join(CACHE_DIR, "results.sqlite")
+
+_COMMENT = re.compile(r"//[^\n]*")
+_SPACE = re.compile(r"\s+")
+
+_code_version = None
+
+
+def normalize(src):
+    """Program text with comments dropped and whitespace collapsed"""
+    # the language has no string literals, so // always starts a comment
+    return _SPACE.sub(" ", _COMMENT.sub("", src)).strip()
+
+
+def code_version():
+    """Hash of the grammar and the interpreter's source files"""
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha256()
+        here = os.path.dirname(GRAMMAR_PATH)
+        paths = [GRAMMAR_PATH] + sorted(glob.glob(os.path.join(here, "*.py")))
+        for path in paths:
+            if path.endswith("_test.py"):
+                continue
+            h.update(os.path.basename(path).encode() + b"\0")
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def cache_key(src, backend="rewrite", passes=None, max_steps=MAX_STEPS):
+    h = hashlib.sha256()
+    h.update(code_version().encode())
+    passes = "-" if passes is None else ",".join(passes)
+    h.update(f"\0{backend}\0{passes}\0{max_steps}\0".encode())
+    h.update(normalize(src).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    LRU in memory, backed by an SQLite file at path (None: memory only).
+    stats counts memory hits, disk hits, misses and evictions (from
+    either level).
+    """
+
+    def __init__(self, path=DEFAULT_PATH, lru_size=LRU_SIZE, max_entries=MAX_ENTRIES):
+        self.lru = collections.OrderedDict()
+        self.lru_size = lru_size
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self.db = None
+        self.rows = 0
+        # key -> time of its last disk hit, not yet written
+        self.touched = {}
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            db = sqlite3.connect(path, timeout=10)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results"
+                " (key TEXT PRIMARY KEY, result TEXT NOT NULL, used REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            db.commit()
+            (self.rows,) = db.execute("SELECT COUNT(*) FROM results").fetchone()
+        except (OSError, sqlite3.Error):
+            # a cache we cannot write only costs speed
+            return
+        self.db = db
+
+    def close(self):
+        if self.db is not None:
+            try:
+                self._touch()
+                self.db.commit()
+            except sqlite3.Error:
+                pass
+            self.db.close()
+            self.db = None
+
+    def _touch(self):
+        # write the pending last-used times, in the caller's transaction
+        if self.touched:
+            self.db.executemany(
+                "UPDATE results SET used = ? WHERE key = ?",
+                [(used, key) for key, used in self.touched.items()],
+            )
+            self.touched.clear()
+
+    # ----------------------------------------------------------------
+
+    def get(self, key):
+        """Cached result for key, or None"""
+        result = self.lru.get(key)
+        if result is not None:
+            self.lru.move_to_end(key)
+            self.stats["hits"] += 1
+            return result
+
+        if self.db is not None:
+            try:
+                row = self.db.execute(
+                    "SELECT result FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self.touched[key] = time.time()
+                    if len(self.touched) >= TOUCH_BATCH:
+                        self._touch()
+                        self.db.commit()
+            except sqlite3.Error:
+                row = None
+            if row is not None:
+                self.stats["disk_hits"] += 1
+                self._remember(key, row[0])
+                return row[0]
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.db is None:
+            return
+        try:
+            # the eviction below must see the last-used times of the hits
+            self._touch()
+            now = time.time()
+            added = self.db.execute(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?)", (key, result, now)
+            ).rowcount
+            if added:
+                self.rows += 1
+            else:
+                self.db.execute(
+                    "UPDATE results SET result = ?, used = ? WHERE key = ?", (result, now, key)
+                )
+            if self.rows > self.max_entries:
+                evicted = self.db.execute(
+                    "DELETE FROM results WHERE key IN"
+                    " (SELECT key FROM results ORDER BY used LIMIT ?)",
+                    (self.rows - self.max_entries,),
+                ).rowcount
+                self.rows -= evicted
+                self.stats["evictions"] += evicted
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    def _remember(self, key, result):
+        self.lru[key] = result
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    # ----------------------------------------------------------------
+
+    def interpret(self, src, backend="rewrite", passes=None, max_steps=MAX_STEPS):
+        """interpreter.interpret(), through the cache"""
+        key = cache_key(src, backend, passes, max_steps)
+        result = self.get(key)
+        if result is None:
+            result = interpreter.interpret(src, backend=backend, passes=passes, max_steps=max_steps)
+            self.put(key, result)
+        return result
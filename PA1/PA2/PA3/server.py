@@ -0,0 +1,334 @@
+"""
+server.py
+
+Evaluation service for the PA3 interpreter.
+
+Listens on a Unix-domain socket or a localhost TCP port and runs programs on
+a pool of worker processes started up front, each holding a built parser,
+so a request costs neither a Python start nor a grammar build. Every
+connection may send any number of requests, one JSON object per line, and
+gets one JSON line back for each:
+
+    {"src": "1 + 2"}                      -> {"status": "ok", "output": "3.0",
+                                              "error": null, "ms": 0.4}
+    {"src": "...", "backend": "vm", "passes": ["fold"], "max_steps": 1000,
+     "timeout": 2}
+    {"stats": true}                       -> counters, see Pool.snapshot()
+
+status is as in batch.py, or "timeout". A worker still running a program
+after the timeout is killed and replaced. A worker is also replaced after
+max_requests programs, or once its resident memory passes max_rss_mb.
+
+    python3 server.py --unix /tmp/pa3.sock --workers 4
+    python3 server.py --port 7354
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from interpreter import MAX_STEPS, _resident_mb, get_parser
+from batch import Outcome, run_one, ERROR
+
+
+WORKERS = os.cpu_count() or 1
+TIMEOUT = 10.0           # seconds per program
+MAX_REQUESTS = 1000      # programs a worker runs before it is replaced
+MAX_RSS_MB = 512         # resident memory before a worker is replaced
+MAX_REQUEST_BYTES = 1 << 20
+
+TIMED_OUT = "timeout"
+
+
+# --------------------------------------------------------------------
+# Workers
+# --------------------------------------------------------------------
+
+def _worker_main(conn):
+    get_parser()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        conn.send((run_one(**job), _resident_mb()))
+
+
+def _context():
+    # the accepting threads make fork unsafe; a fork server forks the
+    # workers from a clean process that has the interpreter imported
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # the fork server imports these from its current directory before
+        # it takes our sys.path, so from anywhere else (e.g. PA2, with its
+        # own interpreter.py) the workers import them themselves
+        if os.path.samefile(os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
+            ctx.set_forkserver_preload(["interpreter", "batch", "server"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+class Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.served = 0
+        self.rss_mb = 0.0
+
+    def stop(self):
+        self.conn.close()
+        self.process.kill()
+        self.process.join()
+
+
+class Pool:
+    """Worker processes handed out to one request at a time"""
+
+    def __init__(self, size=WORKERS, max_requests=MAX_REQUESTS, max_rss_mb=MAX_RSS_MB):
+        self.ctx = _context()
+        self.size = size
+        self.max_requests = max_requests
+        self.max_rss_mb = max_rss_mb
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "ok": 0, "non-terminating": 0, "error": 0,
+                      TIMED_OUT: 0, "recycled": 0}
+        self.workers = []
+        self.closed = False
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self._start()
+
+    def _start(self):
+        worker = Worker(self.ctx)
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                self.workers.append(worker)
+        if closed:
+            worker.stop()
+        else:
+            self.idle.put(worker)
+
+    def _replace(self, worker):
+        with self.lock:
+            # after close() the worker is already stopped and gets no successor
+            if self.closed:
+                return
+            self.workers.remove(worker)
+        worker.stop()
+        self._start()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def run(self, job, timeout=TIMEOUT):
+        """Outcome of batch.run_one(**job) in the next free worker"""
+        self._count("requests")
+        worker = self.idle.get()
+        try:
+            worker.conn.send(job)
+            if not worker.conn.poll(timeout):
+                self._count(TIMED_OUT)
+                self._replace(worker)
+                return Outcome(TIMED_OUT, None, f"no result after {timeout:g} s")
+            outcome, worker.rss_mb = worker.conn.recv()
+        except (EOFError, OSError):
+            # the worker died, e.g. killed for its memory
+            self._count(ERROR)
+            self._replace(worker)
+            return Outcome(ERROR, None, "worker died")
+
+        self._count(outcome.status)
+        worker.served += 1
+        if worker.served >= self.max_requests or worker.rss_mb > self.max_rss_mb:
+            self._count("recycled")
+            self._replace(worker)
+        else:
+            self.idle.put(worker)
+        return outcome
+
+    def snapshot(self):
+        with self.lock:
+            out = dict(self.stats)
+            out["workers"] = len(self.workers)
+            out["busy"] = len(self.workers) - self.idle.qsize()
+            out["served"] = [w.served for w in self.workers]
+            out["rss_mb"] = [round(w.rss_mb, 1) for w in self.workers]
+        out["uptime"] = round(time.time() - self.started, 3)
+        return out
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+
+
+# --------------------------------------------------------------------
+# Protocol
+# --------------------------------------------------------------------
+
+def _is_number(x):
+    # bool is an int, but not a number a client means
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def _job(request, timeout):
+    """(job, timeout) for a request; ValueError says what is wrong with it"""
+    src = request.get("src")
+    if not isinstance(src, str):
+        raise ValueError("no src")
+    backend = request.get("backend", "rewrite")
+    if not isinstance(backend, str):
+        raise ValueError("backend must be a string")
+    passes = request.get("passes")
+    if passes is not None and not (
+            isinstance(passes, list) and all(isinstance(p, str) for p in passes)):
+        raise ValueError("passes must be a list of strings")
+    max_steps = request.get("max_steps", MAX_STEPS)
+    if not (_is_number(max_steps) and max_steps == int(max_steps) and max_steps >= 0):
+        raise ValueError("max_steps must be a whole number >= 0")
+    asked = request.get("timeout", timeout)
+    if not (_is_number(asked) and 0 < asked < float("inf")):
+        raise ValueError("timeout must be a number > 0")
+
+    job = {"src": src, "backend": backend, "passes": passes, "max_steps": int(max_steps)}
+    # a client may ask for less time, not more
+    return job, min(float(asked), timeout)
+
+
+def handle(pool, request, timeout=TIMEOUT):
+    """Reply (a dict) to one decoded request"""
+    if request.get("stats"):
+        return pool.snapshot()
+
+    try:
+        job, timeout = _job(request, timeout)
+    except ValueError as e:
+        return {"status": ERROR, "output": None, "error": f"bad request: {e}"}
+
+    start = time.perf_counter()
+    status, output, error = pool.run(job, timeout)
+    ms = (time.perf_counter() - start) * 1000
+    return {"status": status, "output": output, "error": error, "ms": round(ms, 3)}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_BYTES + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST_BYTES:
+                reply = {"status": ERROR, "output": None, "error": "bad request: too long"}
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+                return
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("not an object")
+                reply = handle(self.server.pool, request, self.server.timeout_s)
+            except RecursionError:
+                # json.loads recurses once per level of nesting
+                reply = {"status": ERROR, "output": None, "error": "bad request: nested too deeply"}
+            except ValueError as e:
+                reply = {"status": ERROR, "output": None, "error": f"bad request: {e}"}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _remove_socket(path):
+    """Unlink a leftover socket at path; anything else there is an error"""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    os.unlink(path)
+
+
+def make_server(address, pool, timeout=TIMEOUT):
+    """
+    Server on address: a path for a Unix-domain socket, or (host, port).
+    A socket left at the path is replaced; any other file there raises
+    FileExistsError. Call serve_forever() to run it; server_close() also
+    stops the pool.
+    """
+    if isinstance(address, str):
+        _remove_socket(address)
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    server.pool = pool
+    server.timeout_s = timeout
+
+    close = server.server_close
+
+    def server_close():
+        close()
+        pool.close()
+        if isinstance(address, str):
+            _remove_socket(address)
+    server.server_close = server_close
+    return server
+
+
+def call(address, **request):
+    """Send one request to a running server and return its reply"""
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def main():
+    ap = argparse.ArgumentParser(description="PA3 evaluation server")
+    where = ap.add_mutually_exclusive_group(required=True)
+    where.add_argument("--unix", metavar="PATH", help="listen on a Unix-domain socket")
+    where.add_argument("--port", type=int, help="listen on localhost TCP")
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    ap.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds per program")
+    ap.add_argument("--max-requests", type=int, default=MAX_REQUESTS,
+                    help="programs a worker runs before it is replaced")
+    ap.add_argument("--max-rss-mb", type=float, default=MAX_RSS_MB,
+                    help="resident memory at which a worker is replaced")
+    args = ap.parse_args()
+
+    pool = Pool(args.workers, args.max_requests, args.max_rss_mb)
+    address = args.unix if args.unix else ("127.0.0.1", args.port)
+    server = make_server(address, pool, args.timeout)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
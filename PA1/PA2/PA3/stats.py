@@ -0,0 +1,185 @@
+"""
+stats.py
+
+Counts what the rewrite evaluator does.
+
+A Stats is handed to interpreter.evaluate() as its stats argument, which
+passes it down to step(), the step rules, substitute(), free_vars() and
+the name generator; each counts into the one it was given. Evaluations
+without one count nothing, and evaluations in other threads, counted or
+not, do not touch it.
+
+Term sizes are numbers of nodes counted as a tree. They are kept per node,
+and a step adds the size of its reduct less that of its redex, so only the
+nodes it built are counted.
+
+    python3 interpreter.py --stats "<expr>"      counters as JSON on stderr
+"""
+
+import json
+
+import interpreter
+from interpreter import (
+    MAX_STEPS, NON_TERMINATING, LambdaCalculusTransformer, LimitExceeded, Report,
+    get_parser, linearize, show_report,
+)
+
+
+SIZE_CACHE_LIMIT = 1 << 20
+
+ARITHMETIC_RULES = ("plus", "minus", "times", "neg")
+
+
+class Stats:
+    """
+    Counters for one evaluation. rules maps the tag of each redex to the
+    number of times its rule fired ("app" is beta reduction).
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.rules = {}
+        self.substitute_calls = 0
+        self.nodes_copied = 0
+        self.free_vars_calls = 0
+        self.fresh_names = 0
+        self.peak_size = 0
+        self.final_size = 0
+        self._sizes = _Sizes()
+
+    # called by the evaluator (see interpreter.evaluate_iter)
+
+    def start(self, t):
+        self.peak_size = self.final_size = self._sizes.size(t)
+
+    def fired(self, redex, reduct):
+        # packing a list does not change its size, so the term grows by
+        # what the reduct adds over the redex
+        self.steps += 1
+        self.rules[redex[0]] = self.rules.get(redex[0], 0) + 1
+        sizes = self._sizes
+        self.final_size = n = self.final_size + sizes.size(reduct) - sizes.size(redex)
+        if n > self.peak_size:
+            self.peak_size = n
+
+    @property
+    def beta(self):
+        return self.rules.get("app", 0)
+
+    @property
+    def fix(self):
+        return self.rules.get("fix", 0)
+
+    @property
+    def arithmetic(self):
+        return sum(self.rules.get(tag, 0) for tag in ARITHMETIC_RULES)
+
+    def as_dict(self):
+        return {
+            "steps": self.steps,
+            "beta": self.beta,
+            "fix": self.fix,
+            "arithmetic": self.arithmetic,
+            "substitute_calls": self.substitute_calls,
+            "nodes_copied": self.nodes_copied,
+            "free_vars_calls": self.free_vars_calls,
+            "fresh_names": self.fresh_names,
+            "peak_size": self.peak_size,
+            "final_size": self.final_size,
+            "rules": dict(sorted(self.rules.items())),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict())
+
+
+class _Sizes:
+    """
+    Tree sizes of terms, cached per node (the entry keeps the node alive).
+    A packed list counts as the cons cells it stands for; the sizes of its
+    items are summed from running totals kept per buffer, which grow in
+    both directions as the buffer does.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.totals = {}
+
+    def _upto(self, entry, i):
+        # total size of the items from entry's base up to i (negative below it)
+        items, base, up, down = entry
+        if i >= base:
+            while len(up) <= i - base:
+                x = items[base + len(up) - 1]
+                up.append(up[-1] + (self.size(x) if x[0] == "list" else 1))
+            return up[i - base]
+        while len(down) <= base - i:
+            x = items[base - len(down)]
+            down.append(down[-1] + (self.size(x) if x[0] == "list" else 1))
+        return -down[base - i]
+
+    def _items(self, t):
+        items, lo, hi = t[2], t[3], t[4]
+        entry = self.totals.get(id(items))
+        if entry is None:
+            entry = self.totals[id(items)] = (items, lo, [0], [0])
+        return self._upto(entry, hi) - self._upto(entry, lo)
+
+    def size(self, t):
+        cache = self.cache
+        hit = cache.get(id(t))
+        if hit is not None:
+            return hit[1]
+        if len(cache) >= SIZE_CACHE_LIMIT:
+            cache.clear()
+            self.totals.clear()
+
+        stack = [t]
+        while stack:
+            node = stack[-1]
+            total = 1
+            missing = False
+            for x in node[1:]:
+                if type(x) is tuple:
+                    hit = cache.get(id(x))
+                    if hit is None:
+                        stack.append(x)
+                        missing = True
+                    else:
+                        total += hit[1]
+            if not missing:
+                stack.pop()
+                if node[0] == "list":
+                    total += node[4] - node[3] - 1 + self._items(node)
+                cache[id(node)] = (node, total)
+        return cache[id(t)][1]
+
+
+def evaluate(t, max_steps=MAX_STEPS, limits=None):
+    """
+    interpreter.evaluate() with counting: (value, Stats). An exception it
+    raises carries the counters so far as its stats attribute.
+    """
+    stats = Stats()
+    try:
+        return interpreter.evaluate(t, max_steps, limits, stats), stats
+    except RuntimeError as e:
+        e.stats = stats
+        raise
+
+
+def run(src, passes=None, max_steps=MAX_STEPS, limits=None):
+    """interpret() on the rewrite backend with counting: (output, Stats)"""
+    interpreter.ng.reset()
+    ast = LambdaCalculusTransformer().transform(get_parser().parse(src))
+    if passes is not None:
+        from optimize import optimize
+        ast, _ = optimize(ast, passes)
+    try:
+        value, stats = evaluate(ast, max_steps, limits)
+    except LimitExceeded as e:
+        return show_report(Report(None, e.limit, e.steps, e.seconds)), e.stats
+    except RuntimeError as e:
+        return NON_TERMINATING, e.stats
+    return linearize(value, top=True), stats
+
@@ -0,0 +1,93 @@
+"""
+streaming.py
+
+PA3's --stream mode: programs are read from a binary stream and one result
+is written per program. This module imports nothing from interpreter.py;
+the caller passes the run function. PA1's calculator_cfg.py and PA2's
+interpreter.py keep their own copies of the loop.
+"""
+
+import json
+import time
+
+
+STREAM_CHUNK = 1 << 16
+
+# longest program read, in bytes
+MAX_RECORD = 1 << 24
+
+
+def records(inp, sep=b"\n", max_record=MAX_RECORD):
+    """
+    Programs read from the binary stream inp, separated by the byte sep.
+    Reads only what is available, so each program is run as soon as it
+    arrives; blank ones are skipped. A program longer than max_record bytes
+    is not kept: the input is skipped up to the next separator and None is
+    yielded in its place.
+    """
+    pieces = []     # the current program so far, joined once it ends
+    size = 0        # their total length, or None once past max_record
+    while True:
+        chunk = inp.read1(STREAM_CHUNK)
+        if not chunk:
+            break
+        parts = chunk.split(sep)
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            if size is not None:
+                size += len(part)
+                if size > max_record:
+                    pieces, size = [], None
+                else:
+                    pieces.append(part)
+            if i == last:
+                break
+            if size is None:
+                yield None
+            else:
+                src = b"".join(pieces)
+                if src.strip():
+                    yield src.decode("utf-8", errors="replace")
+            pieces, size = [], 0
+    if size is None:
+        yield None
+    else:
+        src = b"".join(pieces)
+        if src.strip():
+            yield src.decode("utf-8", errors="replace")
+
+
+def describe(e):
+    """Default error text for an exception raised by run"""
+    return f"{type(e).__name__}: {e}"
+
+
+def stream(inp, out, run, sep=b"\n", as_json=False, line_buffered=False,
+           describe=describe, error_format="<error: {}>", max_record=MAX_RECORD,
+           **options):
+    """
+    Run every program from inp (see records) with run(src, **options) and
+    write one result per line to out, or one JSON object with the time
+    taken. An exception from run is written as the first line of
+    describe(e), through error_format outside JSON, and the stream goes on;
+    so is a program longer than max_record bytes.
+    """
+    for src in records(inp, sep, max_record):
+        start = time.perf_counter()
+        try:
+            if src is None:
+                raise ValueError(f"program longer than {max_record} bytes")
+            result, error = run(src, **options), None
+        except Exception as e:
+            result, error = None, describe(e).splitlines()[0]
+        ms = (time.perf_counter() - start) * 1000
+
+        if as_json:
+            record = {"result": result} if error is None else {"error": error}
+            record["ms"] = round(ms, 3)
+            out.write(json.dumps(record) + "\n")
+        else:
+            out.write((result if error is None else error_format.format(error)) + "\n")
+        if line_buffered:
+            out.flush()
+    out.flush()
@@ -0,0 +1,416 @@
+"""
+transpile.py
+
+Translates a PA3 program into Python source and runs the compiled result.
+
+Every lambda body, delayed argument, let body and if branch becomes a
+top-level def taking the environment; a letrec binds its name to the
+closure of a generated def whose environment contains that binding, so
+recursive calls go straight back into the generated function.
+Tail calls return to the trampoline in closures.apply, as in closures.py.
+Lists are the linked Cons cells of machine.py, and values, environments and
+read back are shared with machine.py and closures.py, so results print
+exactly as with the other backends. The terms needed for read back are
+emitted packed (see arena.py): one bytes literal and a list of names and
+numbers, rebuilt into tuples when the module runs, so the generated module
+needs nothing from the parser, and compiling it does not cost a statement
+per node. transpile(t, packed=False) emits them as tuple literals instead,
+one assignment per node, which is easier to read.
+
+The code object compiled from the generated source is cached on disk
+(marshal), keyed by a hash of the program text, the grammar, the sources of
+the modules that generate and run the code (SOURCES), this module's VERSION
+and the Python version. Running the same program again skips
+parsing, transforming and transpiling altogether. Once the cache holds more
+than MAX_CACHE_BYTES, storing a program removes the least recently used
+ones until it is back under three quarters of that.
+
+    python3 transpile.py "<expr>"      prints the generated source
+"""
+
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+from array import array
+
+from interpreter import MAX_STEPS, GRAMMAR_PATH, CACHE_DIR
+import arena
+from debruijn import compile_term, mark_tail_calls, cheap
+import machine
+from machine import NIL, Cons, Neutral, reify, close_term, values_equal, speculate, evaluated, Speculated
+import closures
+from closures import CClosure, CThunk, force, apply, tail_call, unfold, letrec
+
+
+# bump when the generated code changes shape
+VERSION = 4
+
+# modules whose source decides the generated code; editing one of them
+# invalidates the cache
+SOURCES = ("interpreter.py", "debruijn.py", "machine.py", "closures.py", "transpile.py", "arena.py")
+
+# size of the on-disk code cache at which old entries are removed
+MAX_CACHE_BYTES = 64 << 20
+
+
+# --------------------------------------------------------------------
+# Runtime helpers the generated code calls
+# --------------------------------------------------------------------
+
+def _binop(op, l, r):
+    if type(l) is float and type(r) is float:
+        if op == "plus":
+            return l + r
+        if op == "minus":
+            return l - r
+        if op == "times":
+            return l * r
+        return 1.0 if l <= r else 0.0
+    return Neutral((op, reify(l), reify(r)))
+
+
+def _plus(l, r):
+    if type(l) is float and type(r) is float:
+        return l + r
+    return _binop("plus", l, r)
+
+
+def _minus(l, r):
+    if type(l) is float and type(r) is float:
+        return l - r
+    return _binop("minus", l, r)
+
+
+def _times(l, r):
+    if type(l) is float and type(r) is float:
+        return l * r
+    return _binop("times", l, r)
+
+
+def _leq(l, r):
+    return _binop("leq", l, r)
+
+
+def _eq(l, r):
+    return 1.0 if values_equal(l, r) else 0.0
+
+
+def _neg(v):
+    return -v if type(v) is float else Neutral(("neg", reify(v)))
+
+
+def _hd(v):
+    return v.head if isinstance(v, Cons) else Neutral(("hd", reify(v)))
+
+
+def _tl(v):
+    return v.tail if isinstance(v, Cons) else Neutral(("tl", reify(v)))
+
+
+def _prog(l, r):
+    return Neutral(("prog", reify(l), reify(r)))
+
+
+def _if(v, env, node, then, other):
+    if type(v) is float:
+        if v == 1.0:
+            return then(env)
+        if v == 0.0:
+            return other(env)
+    return Neutral(("if", reify(v), close_term(node[2], env), close_term(node[3], env)))
+
+
+def _spec(c, env, code):
+    n = speculate(c, env)
+    return CThunk(c, env, code) if n is None else Speculated(c, env, n)
+
+
+def _node(*node):
+    return node
+
+
+def _unpack(code, consts):
+    """The nodes of a packed program (see _Gen.const_lines), as plain tuples"""
+    packed = array("i")
+    packed.frombytes(code)
+    return arena.nodes(arena.Arena(packed, consts), _node)
+
+
+RUNTIME = {
+    "NIL": NIL, "Cons": Cons, "Neutral": Neutral,
+    "CClosure": CClosure, "CThunk": CThunk,
+    "force": force, "apply": apply, "tail_call": tail_call, "unfold": unfold, "letrec": letrec,
+    "_plus": _plus, "_minus": _minus, "_times": _times, "_leq": _leq, "_eq": _eq,
+    "_neg": _neg, "_hd": _hd, "_tl": _tl, "_prog": _prog, "_if": _if,
+    "_spec": _spec, "evaluated": evaluated, "_unpack": _unpack,
+    # repr() of a non-finite float
+    "inf": float("inf"), "nan": float("nan"),
+}
+
+
+# --------------------------------------------------------------------
+# Code generation
+# --------------------------------------------------------------------
+
+class _Gen:
+    def __init__(self, packed=True):
+        self.packed = packed
+        self.consts = []      # "T3 = (...)" lines, unless packed
+        self.wanted = []      # (name, node) to take from the packed nodes
+        self.defs = []        # generated functions
+        self._const_names = {}
+
+    def const(self, c):
+        """Name of a module-level constant equal to compiled node c"""
+        name = self._const_names.get(id(c))
+        if name is not None:
+            return name
+        if self.packed:
+            name = f"T{len(self._const_names)}"
+            self.wanted.append((name, c))
+        else:
+            parts = []
+            for x in c:
+                parts.append(self.const(x) if isinstance(x, tuple) else repr(x))
+            name = f"T{len(self.consts)}"
+            self.consts.append(f"{name} = ({', '.join(parts)},)")
+        self._const_names[id(c)] = name
+        return name
+
+    def const_lines(self, root):
+        """The lines defining the constants, every one a subterm of root"""
+        if not self.packed:
+            return self.consts
+        index = {}
+        packed = arena.pack(root, index)
+        lines = [f"NODES = _unpack({packed.code.tobytes()!r}, {packed.consts!r})"]
+        lines += [f"{name} = NODES[{index[id(c)]}]" for name, c in self.wanted]
+        return lines
+
+    def function(self, c):
+        """Name of a generated def(env) returning the value of c"""
+        name = f"f{len(self.defs)}"
+        self.defs.append(None)
+        body = self.expr(c)
+        self.defs[int(name[1:])] = f"def {name}(env):\n    return {body}\n"
+        return name
+
+    def thunk(self, c, spec=False):
+        if c[0] == "bvar":
+            # pass the variable's own thunk along
+            return "env" + "[2]" * c[1] + "[1]"
+        if c[0] == "num":
+            # nothing to delay, even by name
+            return f"evaluated({c[1]!r})"
+        if spec and cheap(c):
+            # argument of a call inside a lambda body
+            return f"_spec({self.const(c)}, env, {self.function(c)})"
+        return f"CThunk({self.const(c)}, env, {self.function(c)})"
+
+    def expr(self, c):
+        tag = c[0]
+
+        if tag == "num":
+            return repr(c[1])
+        if tag == "bvar":
+            return f"force({self.thunk(c)})"
+        if tag == "free":
+            return f"Neutral(('var', {c[1]!r}))"
+        if tag == "nil":
+            return "NIL"
+        if tag == "lam":
+            return f"CClosure({self.const(c)}, env, {self.function(c[2])})"
+        if tag in ("app", "sapp"):
+            return f"apply({self.expr(c[1])}, {self.thunk(c[2], tag == 'sapp')})"
+        if tag == "tapp":
+            return f"tail_call({self.expr(c[1])}, {self.thunk(c[2], True)})"
+        if tag in ("plus", "minus", "times", "leq", "eq"):
+            return f"_{tag}({self.expr(c[1])}, {self.expr(c[2])})"
+        if tag in ("neg", "hd", "tl"):
+            return f"_{tag}({self.expr(c[1])})"
+        if tag == "if":
+            return (f"_if({self.expr(c[1])}, env, {self.const(c)}, "
+                    f"{self.function(c[2])}, {self.function(c[3])})")
+        if tag == "let":
+            # let x = e1 in e2  -->  (\x.e2) e1
+            return f"{self.function(c[3])}(({c[1]!r}, {self.thunk(c[2])}, env))"
+        if tag == "letrec":
+            # letrec f = e1 in e2  -->  let f = (fix (\f.e1)) in e2
+            fixed = c[2]
+            value = fixed[1][2]
+            closure = self.function(value) if value[0] == "lam" else "None"
+            env = f"letrec({c[1]!r}, {self.const(fixed)}, {self.function(fixed)}, env, {closure})"
+            return f"{self.function(c[3])}({env})"
+        if tag == "fix":
+            return f"unfold({self.expr(c[1])})"
+        if tag == "cons":
+            return f"Cons({self.expr(c[1])}, {self.expr(c[2])})"
+        if tag == "prog":
+            return f"_prog({self.expr(c[1])}, {self.expr(c[2])})"
+
+        raise ValueError(f"cannot transpile node: {tag}")
+
+
+def transpile(t, packed=True):
+    """
+    Python source for tuple AST t; running it defines main() and PROGRAM.
+    packed=False emits the terms as tuple literals (see the module
+    docstring).
+    """
+    c = mark_tail_calls(compile_term(t))
+    gen = _Gen(packed)
+    root = gen.expr(c)
+    program = gen.const(c)
+    return "\n".join([
+        "# generated by transpile.py",
+        *gen.const_lines(c),
+        f"PROGRAM = {program}",
+        "",
+        *gen.defs,
+        f"def main(env=None):\n    return {root}\n",
+    ])
+
+
+# --------------------------------------------------------------------
+# Running and caching
+# --------------------------------------------------------------------
+
+def run_code(code, max_steps=MAX_STEPS):
+    """Run a compiled transpiled program to a tuple term"""
+    ns = dict(RUNTIME)
+    exec(code, ns)
+    closures.fuel[0] = max_steps
+    try:
+        return reify(ns["main"]())
+    except RecursionError:
+        pass
+    # too deep (or not terminating) for Python's stack
+    return reify(machine.run(ns["PROGRAM"], max_steps=max_steps))
+
+
+def compile_ast(t):
+    """Code object for tuple AST t, or None if Python cannot compile it"""
+    try:
+        return compile(transpile(t), "<pa3>", "exec")
+    except (RecursionError, SyntaxError, MemoryError):
+        # nesting deeper than the Python compiler accepts
+        return None
+
+
+def evaluate(t, max_steps=MAX_STEPS):
+    """Drop-in replacement for interpreter.evaluate"""
+    code = compile_ast(t)
+    if code is None:
+        return machine.evaluate(t, max_steps)
+    return run_code(code, max_steps)
+
+
+_code_version = None
+
+
+def code_version():
+    """Hash of VERSION, the Python version, the grammar and SOURCES"""
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha256()
+        h.update(f"{VERSION}\0".encode())
+        h.update(importlib.util.MAGIC_NUMBER)
+        here = os.path.dirname(os.path.abspath(__file__))
+        paths = [GRAMMAR_PATH] + [os.path.join(here, name) for name in SOURCES]
+        for path in paths:
+            h.update(os.path.basename(path).encode() + b"\0")
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def cache_key(src):
+    h = hashlib.sha256()
+    h.update(code_version().encode())
+    h.update(b"\0" + src.encode())
+    return h.hexdigest()
+
+
+def load_cached(src):
+    """Cached code object for program text src, or None"""
+    path = os.path.join(CACHE_DIR, cache_key(src) + ".bin")
+    try:
+        with open(path, "rb") as f:
+            code = marshal.load(f)
+        # the modification time orders entries by last use (see _prune)
+        os.utime(path)
+        return code
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _prune():
+    """Remove the least recently used entries once the cache is too big"""
+    entries = []
+    total = 0
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".bin"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    if total <= MAX_CACHE_BYTES:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        if total <= MAX_CACHE_BYTES * 3 // 4:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            # another process pruned it first
+            pass
+        total -= size
+
+
+def store_cached(src, code):
+    path = os.path.join(CACHE_DIR, cache_key(src) + ".bin")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            marshal.dump(code, f)
+        os.replace(tmp, path)
+        _prune()
+    except OSError:
+        # a read-only cache only costs speed
+        pass
+
+
+def evaluate_source(src, max_steps=MAX_STEPS):
+    """Evaluate program text, going through the code-object cache"""
+    code = load_cached(src)
+    if code is not None:
+        return run_code(code, max_steps)
+
+    from interpreter import get_parser, LambdaCalculusTransformer
+
+    ast = LambdaCalculusTransformer().transform(get_parser().parse(src))
+    code = compile_ast(ast)
+    if code is None:
+        return machine.evaluate(ast, max_steps)
+    store_cached(src, code)
+    return run_code(code, max_steps)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: transpile.py "<expr>"')
+        sys.exit(1)
+
+    from interpreter import parser, LambdaCalculusTransformer
+
+    ast = LambdaCalculusTransformer().transform(parser.parse(sys.argv[1]))
+    print(transpile(ast, packed=False))
+
+
+if __name__ == "__main__":
+    main()
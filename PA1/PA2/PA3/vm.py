@@ -0,0 +1,529 @@
+"""
+vm.py
+
+Bytecode compiler and stack VM for the PA3 language.
+
+The de Bruijn form from debruijn.py is compiled once into a Program: a list
+of code blocks, each a flat list of ints [op, arg, op, arg, ...] ending in
+RETURN. Lambda bodies, delayed arguments, let values and if branches get a
+block of their own; an instruction refers to them by block number or
+through the constant pool. The VM then runs the blocks with an operand stack
+and an explicit frame stack, so no term is ever rewritten and no Python
+recursion is involved. A call (or branch, or let body) followed directly by
+RETURN reuses the caller's frame, so tail-recursive loops run in constant
+stack; SPEC passes cheap arithmetic arguments of calls inside lambda bodies
+as numbers (see machine.speculate).
+
+The runtime values, environments and read back are the ones from
+machine.py, so results print exactly as with the other backends.
+
+    python3 vm.py "<expr>"      prints the disassembly and the result
+"""
+
+import sys
+
+from interpreter import MAX_STEPS, linearize
+from debruijn import compile_term, decompile, mark_tail_calls, cheap
+from machine import (
+    NIL, Cons, Closure, Neutral, Thunk, RecThunk, reify, close_term, values_equal,
+    speculate, evaluated, Speculated,
+)
+
+
+# --------------------------------------------------------------------
+# Instruction set
+# --------------------------------------------------------------------
+
+NUM = 0        # NUM c        push consts[c]
+NIL_ = 1       # NIL          push the empty list
+FREE = 2       # FREE c       push the free variable consts[c]
+VAR = 3        # VAR k        force the k-th environment entry
+ARGVAR = 4     # ARGVAR k     push the k-th environment entry unforced
+CLOSURE = 5    # CLOSURE b    push a closure over lambda block b
+THUNK = 6      # THUNK b      push a delayed argument running block b
+APPLY = 7      # APPLY        pop argument and function, call
+ADD = 8
+SUB = 9
+MUL = 10
+EQ = 11
+LEQ = 12
+NEG = 13
+HD = 14
+TL = 15
+CONS = 16      # CONS         pop tail and head, push a cell
+BRANCH = 17    # BRANCH c     pop condition; consts[c] = (if_node, then_b, else_b)
+LET = 18       # LET c        consts[c] = (name, value_b, body_b)
+LETREC = 19    # LETREC c     consts[c] = (name, fix_b, body_b)
+FIX = 20       # FIX          pop function, unfold fix
+PROG = 21      # PROG         pop right and left, push the sequence
+RETURN = 22
+SPEC = 23      # SPEC b       like THUNK, but speculate cheap arithmetic
+
+OPNAMES = [
+    "NUM", "NIL", "FREE", "VAR", "ARGVAR", "CLOSURE", "THUNK", "APPLY",
+    "ADD", "SUB", "MUL", "EQ", "LEQ", "NEG", "HD", "TL", "CONS", "BRANCH",
+    "LET", "LETREC", "FIX", "PROG", "RETURN", "SPEC",
+]
+
+BINOPS = {"plus": ADD, "minus": SUB, "times": MUL, "eq": EQ, "leq": LEQ}
+UNOPS = {"neg": NEG, "hd": HD, "tl": TL}
+
+# native frames: (None, kind, data) on the frame stack
+STUCK_APP = 0  # data = function value; build a stuck application
+UPDATE = 1     # data = thunk; call-by-need memo
+
+
+class VMClosure(Closure):
+    __slots__ = ("code",)
+
+    def __init__(self, term, env, code):
+        self.term = term
+        self.env = env
+        self.code = code
+
+
+class VMThunk(Thunk):
+    __slots__ = ("code",)
+
+    def __init__(self, term, env, code):
+        self.term = term
+        self.env = env
+        self.value = None
+        self.code = code
+
+
+class VMRecThunk(VMThunk, RecThunk):
+    __slots__ = ()
+
+
+# --------------------------------------------------------------------
+# Compiler
+# --------------------------------------------------------------------
+
+class Program:
+    def __init__(self):
+        self.blocks = []     # lists of ints
+        self.sources = []    # compiled node each block was made from
+        self.consts = []
+        self._const_index = {}
+        self._fix_blocks = {}
+
+    def const(self, value):
+        # repr keeps -0.0 apart from 0.0; tuples are never shared
+        key = id(value) if isinstance(value, tuple) else (type(value), repr(value))
+        if key not in self._const_index:
+            self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return self._const_index[key]
+
+    def new_block(self, source):
+        self.blocks.append(None)
+        self.sources.append(source)
+        return len(self.blocks) - 1
+
+    def fix_block(self, lam_block):
+        """Block for the thunk fix F, F being the lambda of lam_block"""
+        b = self._fix_blocks.get(lam_block)
+        if b is None:
+            b = self.new_block(("fix", self.sources[lam_block]))
+            # fix F is F (fix F): build F, then unfold it
+            self.blocks[b] = [CLOSURE, lam_block, FIX, 0, RETURN, 0]
+            self._fix_blocks[lam_block] = b
+        return b
+
+
+def compile_program(c):
+    """Compile a de Bruijn term into a Program; block 0 is the entry point"""
+    prog = Program()
+    pending = [(prog.new_block(c), c)]
+
+    while pending:
+        block, node = pending.pop()
+        prog.blocks[block] = _compile_block(prog, node, pending)
+
+    return prog
+
+
+def _compile_block(prog, node, pending):
+    code = []
+    # nodes to compile, or ints to emit as (op, arg); children first
+    work = [node]
+
+    def sub_block(n, body=None):
+        # a lambda block is made from the lambda but runs its body
+        b = prog.new_block(n)
+        pending.append((b, n if body is None else body))
+        return b
+
+    while work:
+        item = work.pop()
+        if isinstance(item[0], int):
+            code += item
+            continue
+
+        tag = item[0]
+
+        if tag == "num":
+            code += [NUM, prog.const(item[1])]
+
+        elif tag == "nil":
+            code += [NIL_, 0]
+
+        elif tag == "free":
+            code += [FREE, prog.const(item[1])]
+
+        elif tag == "bvar":
+            code += [VAR, item[1]]
+
+        elif tag == "lam":
+            code += [CLOSURE, sub_block(item, item[2])]
+
+        elif tag in ("app", "tapp", "sapp"):
+            arg = item[2]
+            if arg[0] == "bvar":
+                work.append((ARGVAR, arg[1], APPLY, 0))
+            elif tag != "app" and cheap(arg):
+                work.append((SPEC, sub_block(arg), APPLY, 0))
+            else:
+                work.append((THUNK, sub_block(arg), APPLY, 0))
+            work.append(item[1])
+
+        elif tag in BINOPS:
+            work += [(BINOPS[tag], 0), item[2], item[1]]
+
+        elif tag in UNOPS:
+            work += [(UNOPS[tag], 0), item[1]]
+
+        elif tag == "if":
+            c = prog.const((item, sub_block(item[2]), sub_block(item[3])))
+            work += [(BRANCH, c), item[1]]
+
+        elif tag == "let":
+            c = prog.const((item[1], sub_block(item[2]), sub_block(item[3])))
+            code += [LET, c]
+
+        elif tag == "letrec":
+            lam = item[2][1]
+            lam_block = sub_block(lam, lam[2])
+            c = prog.const((item[1], prog.fix_block(lam_block), sub_block(item[3])))
+            code += [LETREC, c]
+
+        elif tag == "fix":
+            work += [(FIX, 0), item[1]]
+
+        elif tag == "cons":
+            work += [(CONS, 0), item[2], item[1]]
+
+        elif tag == "prog":
+            work += [(PROG, 0), item[2], item[1]]
+
+        else:
+            raise ValueError(f"cannot compile node: {tag}")
+
+    code += [RETURN, 0]
+    return code
+
+
+# --------------------------------------------------------------------
+# Disassembler
+# --------------------------------------------------------------------
+
+def _describe(prog, op, arg):
+    if op in (NUM, FREE):
+        return repr(prog.consts[arg])
+    if op in (VAR, ARGVAR):
+        return f"#{arg}"
+    if op in (CLOSURE, THUNK, SPEC):
+        return f"block {arg}"
+    if op == BRANCH:
+        _, then_b, else_b = prog.consts[arg]
+        return f"then block {then_b}, else block {else_b}"
+    if op in (LET, LETREC):
+        name, value_b, body_b = prog.consts[arg]
+        return f"{name} = block {value_b} in block {body_b}"
+    return ""
+
+
+def disassemble(prog):
+    """Readable listing of every block of a Program"""
+    lines = []
+    for b, code in enumerate(prog.blocks):
+        source = linearize(decompile(prog.sources[b]))
+        if len(source) > 60:
+            source = source[:57] + "..."
+        lines.append(f"block {b}: {source}")
+        for pc in range(0, len(code), 2):
+            op, arg = code[pc], code[pc + 1]
+            lines.append(f"  {pc // 2:4}  {OPNAMES[op]:<8} {_describe(prog, op, arg)}".rstrip())
+    return "\n".join(lines)
+
+
+# --------------------------------------------------------------------
+# The VM
+# --------------------------------------------------------------------
+
+def run(prog, max_steps=MAX_STEPS, lazy=False):
+    """Run block 0 of a Program to a runtime value"""
+    blocks = prog.blocks
+    consts = prog.consts
+    stack = []
+    frames = []
+    code, pc, env = blocks[0], 0, None
+    steps = 0
+
+    while True:
+        op = code[pc]
+        arg = code[pc + 1]
+        pc += 2
+
+        if op == VAR:
+            e = env
+            while arg:
+                e = e[2]
+                arg -= 1
+            th = e[1]
+            if th.value is not None:
+                stack.append(th.value)
+            elif not lazy:
+                if code[pc] != RETURN:
+                    frames.append((code, pc, env))
+                code, pc, env = blocks[th.code], 0, th.env
+            else:
+                if code[pc] != RETURN:
+                    frames.append((code, pc, env))
+                frames.append((None, UPDATE, th))
+                code, pc, env = blocks[th.code], 0, th.env
+
+        elif op == NUM:
+            stack.append(consts[arg])
+
+        elif op == THUNK:
+            source = prog.sources[arg]
+            th = VMThunk(source, env, arg)
+            if source[0] == "num":
+                # nothing to delay, even by name
+                th.value = source[1]
+            stack.append(th)
+
+        elif op == SPEC:
+            source = prog.sources[arg]
+            n = speculate(source, env)
+            stack.append(VMThunk(source, env, arg) if n is None else Speculated(source, env, n))
+
+        elif op == ARGVAR:
+            e = env
+            while arg:
+                e = e[2]
+                arg -= 1
+            stack.append(e[1])
+
+        elif op == APPLY:
+            th = stack.pop()
+            f = stack.pop()
+            if code[pc] != RETURN:
+                frames.append((code, pc, env))
+            if isinstance(f, Closure):
+                # beta: run the body with the argument bound
+                steps += 1
+                if steps > max_steps:
+                    raise RuntimeError("non-terminating")
+                code, pc, env = blocks[f.code], 0, (f.term[1], th, f.env)
+            else:
+                # stuck: evaluate the argument, then build f a
+                frames.append((None, STUCK_APP, f))
+                if th.value is not None:
+                    stack.append(th.value)
+                    code, pc = _RETURN_NOW, 0
+                else:
+                    if lazy:
+                        frames.append((None, UPDATE, th))
+                    code, pc, env = blocks[th.code], 0, th.env
+
+        elif op == CLOSURE:
+            stack.append(VMClosure(prog.sources[arg], env, arg))
+
+        elif op == RETURN:
+            # hand the value on top of the stack to the caller
+            if steps > max_steps:
+                raise RuntimeError("non-terminating")
+            while True:
+                if not frames:
+                    return stack.pop()
+                code, pc, env = frames.pop()
+                if code is not None:
+                    break
+                kind, data = pc, env
+                if kind == UPDATE:
+                    data.value = stack[-1]
+                else:
+                    v = stack.pop()
+                    stack.append(Neutral(("app", reify(data), reify(v))))
+
+        elif ADD <= op <= LEQ:
+            # ADD, SUB, MUL, EQ, LEQ
+            right = stack.pop()
+            left = stack.pop()
+            nums = isinstance(left, float) and isinstance(right, float)
+            if op == EQ:
+                steps += 1
+                stack.append(1.0 if values_equal(left, right) else 0.0)
+            elif not nums:
+                name = ("plus", "minus", "times", "eq", "leq")[op - ADD]
+                stack.append(Neutral((name, reify(left), reify(right))))
+            elif op == ADD:
+                steps += 1
+                stack.append(left + right)
+            elif op == SUB:
+                steps += 1
+                stack.append(left - right)
+            elif op == MUL:
+                steps += 1
+                stack.append(left * right)
+            else:
+                steps += 1
+                stack.append(1.0 if left <= right else 0.0)
+
+        elif op == BRANCH:
+            cond = stack.pop()
+            node, then_b, else_b = consts[arg]
+            if isinstance(cond, float) and cond == 1.0:
+                steps += 1
+                if code[pc] != RETURN:
+                    frames.append((code, pc, env))
+                code, pc = blocks[then_b], 0
+            elif isinstance(cond, float) and cond == 0.0:
+                steps += 1
+                if code[pc] != RETURN:
+                    frames.append((code, pc, env))
+                code, pc = blocks[else_b], 0
+            else:
+                stack.append(Neutral((
+                    "if",
+                    reify(cond),
+                    close_term(node[2], env),
+                    close_term(node[3], env),
+                )))
+
+        elif NEG <= op <= TL:
+            # NEG, HD, TL
+            v = stack.pop()
+            if op == NEG and isinstance(v, float):
+                steps += 1
+                stack.append(-v)
+            elif op == HD and isinstance(v, Cons):
+                steps += 1
+                stack.append(v.head)
+            elif op == TL and isinstance(v, Cons):
+                steps += 1
+                stack.append(v.tail)
+            else:
+                stack.append(Neutral((("neg", "hd", "tl")[op - NEG], reify(v))))
+
+        elif op == NIL_:
+            stack.append(NIL)
+
+        elif op == FREE:
+            stack.append(Neutral(("var", consts[arg])))
+
+        elif op == CONS:
+            tail = stack.pop()
+            stack.append(Cons(stack.pop(), tail))
+
+        elif op == LET:
+            # let x = e1 in e2  -->  (\x.e2) e1
+            steps += 1
+            name, value_b, body_b = consts[arg]
+            value = prog.sources[value_b]
+            if value[0] == "bvar":
+                e = env
+                for _ in range(value[1]):
+                    e = e[2]
+                th = e[1]
+            else:
+                th = VMThunk(value, env, value_b)
+                if value[0] == "num":
+                    th.value = value[1]
+            if code[pc] != RETURN:
+                frames.append((code, pc, env))
+            code, pc, env = blocks[body_b], 0, (name, th, env)
+
+        elif op == LETREC:
+            # letrec f = e1 in e2  -->  let f = (fix (\f.e1)) in e2
+            steps += 1
+            name, fix_b, body_b = consts[arg]
+            th = VMRecThunk(prog.sources[fix_b], env, fix_b)
+            if code[pc] != RETURN:
+                frames.append((code, pc, env))
+            env = (name, th, env)
+            # fix block: CLOSURE lam_block, FIX, RETURN
+            th.value = _knot(prog, blocks[fix_b][1], env)
+            code, pc = blocks[body_b], 0
+
+        elif op == FIX:
+            f = stack.pop()
+            if isinstance(f, Closure):
+                # fix F  -->  F (fix F)
+                steps += 1
+                if steps > max_steps:
+                    raise RuntimeError("non-terminating")
+                lam = f.term
+                again = VMRecThunk(("fix", lam), f.env, prog.fix_block(f.code))
+                inner = (lam[1], again, f.env)
+                again.value = _knot(prog, f.code, inner)
+                if again.value is not None:
+                    stack.append(again.value)
+                else:
+                    if code[pc] != RETURN:
+                        frames.append((code, pc, env))
+                    code, pc, env = blocks[f.code], 0, inner
+            else:
+                stack.append(Neutral(("fix", reify(f))))
+
+        elif op == PROG:
+            right = stack.pop()
+            left = stack.pop()
+            stack.append(Neutral(("prog", reify(left), reify(right))))
+
+        else:
+            raise ValueError(f"bad opcode {op}")
+
+
+# a block that returns straight away, used to resume into native frames
+_RETURN_NOW = [RETURN, 0]
+
+
+def _knot(prog, lam_block, env):
+    """
+    If the lambda of lam_block just returns another lambda (letrec f = \\x. ...),
+    that closure in env, which binds f to the RecThunk being tied; else None.
+    """
+    code = prog.blocks[lam_block]
+    if code[0] == CLOSURE and code[2] == RETURN:
+        return VMClosure(prog.sources[code[1]], env, code[1])
+    return None
+
+
+def evaluate(t, max_steps=MAX_STEPS):
+    """Drop-in replacement for interpreter.evaluate"""
+    return reify(run(compile_program(mark_tail_calls(compile_term(t))), max_steps))
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: vm.py "<expr>"')
+        sys.exit(1)
+
+    from interpreter import parser, LambdaCalculusTransformer
+
+    ast = LambdaCalculusTransformer().transform(parser.parse(sys.argv[1]))
+    prog = compile_program(mark_tail_calls(compile_term(ast)))
+    print(disassemble(prog))
+    print()
+    try:
+        print(linearize(reify(run(prog))))
+    except RuntimeError:
+        print("<non-terminating>")
+
+
+if __name__ == "__main__":
+    main()
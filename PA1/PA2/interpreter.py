@@ -1,9 +1,31 @@
 import sys
 import os
+import json
+import time
 from lark import Lark, Transformer
 
-# read grammar
-parser = Lark(open("grammar.lark").read(), parser="lalr")
+# read grammar (next to this file, so it works from any directory)
+GRAMMAR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grammar.lark")
+
+_parser = None
+
+
+# build the parser on first use; lark caches the LALR tables on disk,
+# keyed by a hash of the grammar
+def get_parser():
+    global _parser, parser
+    if _parser is None:
+        with open(GRAMMAR_PATH) as f:
+            _parser = Lark(f.read(), parser="lalr", cache=True)
+        parser = _parser
+    return _parser
+
+
+# lets `interpreter.parser` keep working without building it at import
+def __getattr__(name):
+    if name == "parser":
+        return get_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ast builder
 class LambdaCalculusTransformer(Transformer):
@@ -39,16 +61,28 @@ def linearize(t, top=True):
     return "?"
 
 
-# free vars
+# free vars, cached per node (keyed by id, the entry keeps the node alive)
+_fv_cache = {}
+FV_CACHE_LIMIT = 1 << 20
+
+
 def free_vars(t):
     tag = t[0]
     if tag == 'var':
-        return {t[1]}
+        return frozenset((t[1],))
+    hit = _fv_cache.get(id(t))
+    if hit is not None:
+        return hit[1]
     if tag == 'lam':
-        return free_vars(t[2]) - {t[1]}
-    if tag == 'app':
-        return free_vars(t[1]) | free_vars(t[2])
-    return set()
+        fv = free_vars(t[2]) - {t[1]}
+    elif tag == 'app':
+        fv = free_vars(t[1]) | free_vars(t[2])
+    else:
+        fv = frozenset()
+    if len(_fv_cache) >= FV_CACHE_LIMIT:
+        _fv_cache.clear()
+    _fv_cache[id(t)] = (t, fv)
+    return fv
 
 
 # fresh names
@@ -74,6 +108,10 @@ def substitute(t, name, rep):
     if tag == 'var':
         return rep if t[1] == name else t
 
+    # name does not occur free: share the subtree instead of rebuilding it
+    if name not in free_vars(t):
+        return t
+
     if tag == 'lam':
         v, body = t[1], t[2]
         if v == name:
@@ -129,8 +167,13 @@ def normalize_applications(t):
     return t
 
 
+# the application the last step() beta-reduced, for evaluate_iter's events
+last_redex = None
+
+
 # ONE NORMAL-ORDER STEP
 def step(t):
+    global last_redex
     tag = t[0]
 
     # variable – no reduction
@@ -149,6 +192,7 @@ def step(t):
         # CASE 1: beta-reduction
         if f[0] == 'lam':
             v, body = f[1], f[2]
+            last_redex = t
             return substitute(body, v, a), True
 
         # CASE 2: reduce function first
@@ -164,26 +208,94 @@ def step(t):
 
 
 MAX_STEPS = 10000  # safety limit to detect non-terminating terms
+LOOP_CHECK_EVERY = 16  # fewest steps between two fingerprints of the term
 
 
-# repeat until no more reductions or we hit the step limit
-def evaluate(t):
-    changed = True
-    steps = 0
-    while changed and steps < MAX_STEPS:
-        t, changed = step(t)
-        steps += 1
+# alpha-equivalence key: the term as a flat tuple in preorder, with bound
+# variables as de Bruijn indices and binder names dropped
+def alpha_key(t):
+    out = []
+
+    def walk(u, scope):
+        tag = u[0]
+        out.append(tag)
+        if tag == 'var':
+            if u[1] in scope:
+                out.append(scope[::-1].index(u[1]))
+            else:
+                out.append(u[1])
+        elif tag == 'lam':
+            walk(u[2], scope + [u[1]])
+        elif tag == 'app':
+            walk(u[1], scope)
+            walk(u[2], scope)
+
+    walk(t, [])
+    return tuple(out)
+
+
+# reduce step by step, yielding (n, term) for the term after every
+# every-th step, n being the steps so far: (0, t) first and the normal form
+# last. every=None yields only the normal form. With events=True it yields
+# (n, redex) instead, the application the n-th step reduced. Stops after
+# cap items; returns the normal form (None when stopped by cap). Only what
+# is yielded is kept, so a long trace can be streamed or sampled.
+#
+# step is deterministic and maps alpha-equivalent terms to alpha-equivalent
+# terms, so a term that comes back (up to renaming) loops forever. Brent's
+# algorithm looks for that among a sample of the terms, keeping one saved
+# key, replaced at every power of two. The next sample is taken after as
+# many steps as the key is long, so large terms are fingerprinted rarely.
+def evaluate_iter(t, every=1, cap=None, events=False):
+    sample = every is not None
+    yielded = 0
+    n = 0
+    check = 0
+    saved, power, count = None, 1, 0
+    while True:
+        if n == check:
+            key = alpha_key(t)
+            if key == saved:
+                raise RuntimeError("non-terminating")
+            count += 1
+            if count >= power:
+                saved, power, count = key, power * 2, 0
+            check += max(LOOP_CHECK_EVERY, len(key))
+        if sample and not events and n % every == 0:
+            yield n, t
+            yielded += 1
+            if yielded == cap:
+                return None
+        if n >= MAX_STEPS:
+            # still reducible but we hit the limit: treat as non-terminating
+            raise RuntimeError("non-terminating")
+
+        new, changed = step(t)
+        if not changed:
+            break
+        t = new
+        n += 1
+        if sample and events and n % every == 0:
+            yield n, last_redex
+            yielded += 1
+            if yielded == cap:
+                return None
+
+    if not events and not (sample and n % every == 0):
+        yield n, t
+    return t
 
-    if changed:
-        # still reducible but we hit the limit: treat as non-terminating
-        raise RuntimeError("non-terminating")
 
+# repeat until no more reductions or we hit the step limit
+def evaluate(t):
+    for _, t in evaluate_iter(t, every=None):
+        pass
     return t
 
 
 # run interpreter
 def interpret(src):
-    cst = parser.parse(src)
+    cst = get_parser().parse(src)
     ast = LambdaCalculusTransformer().transform(cst)
 
     # fix associativity of application
@@ -197,10 +309,93 @@ def interpret(src):
         return "<non-terminating>"
 
 
+# longest program read in --stream mode, in bytes
+MAX_RECORD = 1 << 24
+
+
+# streaming: programs read from a binary stream, separated by the byte sep;
+# reads only what is available so each program runs as soon as it arrives.
+# a program is collected as a list of pieces and joined once it ends; one
+# longer than max_record is skipped up to the next separator and yields None
+def records(inp, sep=b"\n", max_record=MAX_RECORD):
+    pieces = []
+    size = 0    # None once past max_record
+    while True:
+        chunk = inp.read1(1 << 16)
+        if not chunk:
+            break
+        parts = chunk.split(sep)
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            if size is not None:
+                size += len(part)
+                if size > max_record:
+                    pieces, size = [], None
+                else:
+                    pieces.append(part)
+            if i == last:
+                break
+            if size is None:
+                yield None
+            else:
+                src = b"".join(pieces)
+                if src.strip():
+                    yield src.decode("utf-8", errors="replace")
+            pieces, size = [], 0
+    if size is None:
+        yield None
+    else:
+        src = b"".join(pieces)
+        if src.strip():
+            yield src.decode("utf-8", errors="replace")
+
+
+# one result per line (or a JSON object with the time taken) per program;
+# a program that fails to parse or is too long gives an error line and the
+# stream goes on
+def stream(inp, out, sep=b"\n", as_json=False, line_buffered=False,
+           max_record=MAX_RECORD):
+    for src in records(inp, sep, max_record):
+        start = time.perf_counter()
+        try:
+            if src is None:
+                raise ValueError(f"program longer than {max_record} bytes")
+            result, error = interpret(src), None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}".splitlines()[0]
+        ms = (time.perf_counter() - start) * 1000
+
+        if as_json:
+            record = {"result": result} if error is None else {"error": error}
+            record["ms"] = round(ms, 3)
+            out.write(json.dumps(record) + "\n")
+        else:
+            out.write((result if error is None else f"<error: {error}>") + "\n")
+        if line_buffered:
+            out.flush()
+    out.flush()
+
+
+USAGE = (
+    'usage: interpreter.py "<expr>" or interpreter.py file.lc\n'
+    '       interpreter.py --stream [-z|--null] [--json] [--line-buffered] < programs'
+)
+
+
 # cli
 def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "--stream":
+        opts = set(sys.argv[2:])
+        if opts - {"-z", "--null", "--json", "--line-buffered"}:
+            print(USAGE)
+            sys.exit(1)
+        null = "-z" in opts or "--null" in opts
+        stream(sys.stdin.buffer, sys.stdout, sep=b"\0" if null else b"\n",
+               as_json="--json" in opts, line_buffered="--line-buffered" in opts)
+        return
+
     if len(sys.argv) != 2:
-        print('usage: interpreter.py "<expr>" or interpreter.py file.lc')
+        print(USAGE)
         sys.exit(1)
 
     arg = sys.argv[1]
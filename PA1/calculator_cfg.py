@@ -4,6 +4,7 @@ calculator_cfg.py
 
 Usage:
     python calculator_cfg.py "1+2*3"
+    python calculator_cfg.py --stream [-z|--null] [--json] [--line-buffered] < exprs
 
 This script:
   1) Loads grammar.lark and builds a Lark parser.
@@ -19,8 +20,10 @@ Notes on design:
 
 import sys
 from lark import Lark, Tree, Token
+import json
 import math
 import os
+import time
 
 # Load grammar from the local file grammar.lark (must be in same directory)
 _THIS_DIR = os.path.dirname(__file__) or "."
@@ -144,10 +147,116 @@ def parse_to_ast(expr_str: str):
     return parser.parse(expr_str)
 
 
+def format_result(result):
+    """Compact representation: integer-valued floats printed as ints"""
+    if isinstance(result, float) and result.is_integer():
+        result = int(result)
+    return str(result)
+
+
+# -----------------------
+# Streaming mode
+# -----------------------
+MAX_RECORD = 1 << 24  # longest expression read, in bytes
+
+
+def records(inp, sep=b"\n", max_record=MAX_RECORD):
+    """
+    Yield the expressions read from the binary stream inp, separated by the
+    byte sep. Only what is available is read, so each expression is
+    evaluated as soon as it arrives. An expression is collected in pieces
+    and joined once it ends; one longer than max_record bytes is skipped up
+    to the next separator and None is yielded in its place. Blank records
+    are skipped.
+    """
+    pieces = []
+    size = 0  # None once past max_record
+    while True:
+        chunk = inp.read1(1 << 16)
+        if not chunk:
+            break
+        parts = chunk.split(sep)
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            if size is not None:
+                size += len(part)
+                if size > max_record:
+                    pieces, size = [], None
+                else:
+                    pieces.append(part)
+            if i == last:
+                break
+            if size is None:
+                yield None
+            else:
+                expr = b"".join(pieces)
+                if expr.strip():
+                    yield expr.decode("utf-8", errors="replace")
+            pieces, size = [], 0
+    if size is None:
+        yield None
+    else:
+        expr = b"".join(pieces)
+        if expr.strip():
+            yield expr.decode("utf-8", errors="replace")
+
+
+def calculate(expr):
+    """
+    The result of expr as main() prints it. Errors are raised as ValueError
+    with the text main() prints for them.
+    """
+    try:
+        ast = parse_to_ast(expr)
+    except Exception as e:
+        raise ValueError(f"Parse error: {e}") from e
+    try:
+        return format_result(evaluate(ast))
+    except Exception as e:
+        raise ValueError(f"Evaluation error: {e}") from e
+
+
+def stream(inp, out, sep=b"\n", as_json=False, line_buffered=False, max_record=MAX_RECORD):
+    """
+    Evaluate every expression from inp and write one result per line to out
+    (or one JSON object per line, with the time taken). Errors are reported
+    on their line, like main() does, and the stream goes on.
+    """
+    for expr in records(inp, sep, max_record):
+        start = time.perf_counter()
+        try:
+            if expr is None:
+                raise ValueError(f"Parse error: expression longer than {max_record} bytes")
+            result, error = calculate(expr), None
+        except ValueError as e:
+            result, error = None, str(e).splitlines()[0]
+        ms = (time.perf_counter() - start) * 1000
+
+        if as_json:
+            record = {"result": result} if error is None else {"error": error}
+            record["ms"] = round(ms, 3)
+            out.write(json.dumps(record) + "\n")
+        else:
+            out.write((result if error is None else error) + "\n")
+        if line_buffered:
+            out.flush()
+    out.flush()
+
+
 # -----------------------
 # Command-line interface
 # -----------------------
 def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == "--stream":
+        opts = set(sys.argv[2:])
+        if opts - {"-z", "--null", "--json", "--line-buffered"}:
+            print("Usage: python calculator_cfg.py --stream [-z|--null] [--json] [--line-buffered]")
+            sys.exit(1)
+        null = "-z" in opts or "--null" in opts
+        stream(sys.stdin.buffer, sys.stdout, sep=b"\0" if null else b"\n",
+               as_json="--json" in opts, line_buffered="--line-buffered" in opts)
+        return
+
     if len(sys.argv) < 2:
         print("Usage: python calculator_cfg.py \"EXPR\"")
         print("Example: python calculator_cfg.py \"2^3^2\"")
@@ -167,9 +276,7 @@ def main():
         sys.exit(3)
 
     # Print using a compact representation: integers printed as ints
-    if isinstance(result, float) and result.is_integer():
-        result = int(result)
-    print(result)
+    print(format_result(result))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+"""
+corpus.py
+
+Programs timed by run.py, per interpreter. Every PA3 program runs on each
+selected backend. Add a program by adding an entry; its name is part of
+the key results are saved and compared under.
+"""
+
+
+def church(n):
+    """The Church numeral n, as PA2 source"""
+    return r"(\f.\x." + "f (" * n + "x" + ")" * n + ")"
+
+
+# PA3: the functional language (PA1/PA2/PA3/interpreter.py)
+PA3 = {
+    "fact": r"letrec f = \x. if x==0 then 1 else x * f(x-1) in f 20",
+    "sum": r"letrec sum = \n. if n == 0 then 0 else n + sum (n-1) in sum 100",
+    "sum-acc": r"letrec sum = \n.\a. if n == 0 then a else sum (n-1) (a+n) in sum 100 0",
+    "map": r"""letrec map = \f.\xs.
+  if xs == # then # else (f (hd xs)) : (map f (tl xs))
+in map (\x.x*2) (1:2:3:4:5:6:7:8:9:10:#)""",
+    # the insertion sort from PA1/PA2/PA3/README.md
+    "sort": r"""letrec insert = \x.\xs.
+  if xs == # then
+    x : #
+  else if (x <= (hd xs)) then
+    x : xs
+  else
+    (hd xs) : (insert x (tl xs))
+in
+letrec sort = \xs.
+  if xs == # then
+    #
+  else
+    insert (hd xs) (sort (tl xs))
+in
+sort (5 : 3 : 4 : 3 : 1 : #)""",
+}
+
+# PA2: the untyped lambda calculus (PA1/PA2/interpreter.py)
+PA2 = {
+    "church-plus": r"(\m.\n.\f.\x.m f (n f x)) " + church(6) + " " + church(6),
+    "church-succ": r"(\n.\f.\x.f (n f x)) ((\n.\f.\x.f (n f x)) " + church(0) + ")",
+    "church-pred": r"(\n.\f.\x.n (\g.\h.h (g f)) (\u.x) (\u.u)) " + church(10),
+}
+
+# PA1: the calculator (PA1/calculator_cfg.py)
+PA1 = {
+    "sum-of-products": " + ".join(f"{i} * {i + 1} - {i}" for i in range(300)),
+    "nested-parens": "(" * 150 + "1" + " + 1)" * 150,
+    "powers-logs": " + ".join(f"(log {2 ** (i % 20 + 1)} base 2) * 2^3^2 - -{i}" for i in range(200)),
+}
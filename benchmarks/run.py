@@ -0,0 +1,285 @@
+"""
+run.py
+
+Benchmark harness for the three interpreters.
+
+Times the phases of every program in corpus.py separately:
+
+    PA3, PA2    parse, transform, evaluate, linearize
+    PA1         parse, evaluate, format
+
+Each program runs warmup times untimed, then repeat times timed, with a
+garbage collection before each run. The report gives the median and the
+95th percentile (nearest rank) of every phase and of their total, in
+milliseconds, and the program's output. Caches inside the interpreters
+are left warm, so the numbers are for a long-running process.
+
+    python3 benchmarks/run.py                         every program, rewrite backend
+    python3 benchmarks/run.py --backend all pa3/sort  one program, every backend
+    python3 benchmarks/run.py --json base.json        save the results
+    python3 benchmarks/run.py --compare base.json     exit 1 on a regression
+
+--compare flags every phase whose median is slower than in the saved
+results by more than --threshold (a fraction) and by more than --min-ms,
+and every program whose output changed.
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import corpus
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PA1_DIR = os.path.join(ROOT, "PA1")
+PA2_DIR = os.path.join(PA1_DIR, "PA2")
+PA3_DIR = os.path.join(PA2_DIR, "PA3")
+
+WARMUP = 1
+REPEAT = 7
+THRESHOLD = 0.10
+MIN_MS = 0.05
+
+
+# --------------------------------------------------------------------
+# Interpreters
+# --------------------------------------------------------------------
+
+def _load(name, path):
+    """The module at path, imported as name (once)"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def pa3_phases(backend):
+    # PA3's other modules import it as "interpreter"
+    sys.path.insert(0, PA3_DIR)
+    import interpreter
+    parser = interpreter.get_parser()
+    evaluate = interpreter.get_backend(backend)
+    return [
+        ("parse", parser.parse),
+        ("transform", interpreter.LambdaCalculusTransformer().transform),
+        ("evaluate", lambda ast: evaluate(ast, interpreter.MAX_STEPS)),
+        ("linearize", lambda value: interpreter.linearize(value, top=True)),
+    ]
+
+
+def pa2_phases():
+    # loaded under its own name: PA3's interpreter is "interpreter"
+    pa2 = _load("pa2_interpreter", os.path.join(PA2_DIR, "interpreter.py"))
+    parser = pa2.get_parser()
+    transformer = pa2.LambdaCalculusTransformer()
+    return [
+        ("parse", parser.parse),
+        ("transform", lambda cst: pa2.normalize_applications(transformer.transform(cst))),
+        ("evaluate", pa2.evaluate),
+        ("linearize", lambda value: pa2.linearize(value, top=True)),
+    ]
+
+
+def pa1_phases():
+    calc = _load("calculator_cfg", os.path.join(PA1_DIR, "calculator_cfg.py"))
+    return [
+        ("parse", calc.parse_to_ast),
+        ("evaluate", calc.evaluate),
+        ("format", calc.format_result),
+    ]
+
+
+def benchmarks(backends):
+    """(key, source, phases) for every program, in a fixed order"""
+    out = []
+    for name, src in corpus.PA1.items():
+        out.append((f"pa1/{name}", src, pa1_phases))
+    for name, src in corpus.PA2.items():
+        out.append((f"pa2/{name}", src, pa2_phases))
+    for backend in backends:
+        for name, src in corpus.PA3.items():
+            out.append((f"pa3/{name}@{backend}", src, lambda b=backend: pa3_phases(b)))
+    return out
+
+
+# --------------------------------------------------------------------
+# Timing
+# --------------------------------------------------------------------
+
+def run_once(phases, src):
+    """(ms per phase, output) of one run"""
+    times = {}
+    x = src
+    for name, fn in phases:
+        start = time.perf_counter_ns()
+        try:
+            x = fn(x)
+        except RuntimeError:
+            # the evaluators' way of giving up on a program
+            times[name] = (time.perf_counter_ns() - start) / 1e6
+            return times, "<non-terminating>"
+        times[name] = (time.perf_counter_ns() - start) / 1e6
+    return times, str(x)
+
+
+def p95(xs):
+    xs = sorted(xs)
+    return xs[max(0, math.ceil(0.95 * len(xs)) - 1)]
+
+
+def summarize(samples):
+    return {"median_ms": round(statistics.median(samples), 4), "p95_ms": round(p95(samples), 4)}
+
+
+def measure(phases, src, warmup=WARMUP, repeat=REPEAT):
+    for _ in range(warmup):
+        run_once(phases, src)
+
+    runs = []
+    output = None
+    for _ in range(repeat):
+        gc.collect()
+        times, output = run_once(phases, src)
+        runs.append(times)
+
+    result = {name: summarize([r[name] for r in runs if name in r]) for name in runs[0]}
+    result["total"] = summarize([sum(r.values()) for r in runs])
+    return {"output": output, "phases": result}
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        from importlib.metadata import version
+        lark_version = version("lark")
+    except Exception:
+        lark_version = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "lark": lark_version,
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+# --------------------------------------------------------------------
+# Reporting
+# --------------------------------------------------------------------
+
+def print_results(results, out=sys.stdout):
+    for key, r in results.items():
+        cells = "  ".join(
+            f"{name} {s['median_ms']:.3f}/{s['p95_ms']:.3f}" for name, s in r["phases"].items()
+        )
+        out.write(f"{key:32} {cells}\n")
+    out.write("(median/p95 ms)\n")
+
+
+def compare(results, baseline, threshold=THRESHOLD, min_ms=MIN_MS, out=sys.stdout):
+    """Print the changes against baseline; returns the number of regressions"""
+    regressions = 0
+    for key, r in results.items():
+        base = baseline.get(key)
+        if base is None:
+            out.write(f"{key:32} new\n")
+            continue
+        if r["output"] != base["output"]:
+            regressions += 1
+            out.write(f"{key:32} OUTPUT CHANGED: {base['output'][:40]!r} -> {r['output'][:40]!r}\n")
+        for name, s in r["phases"].items():
+            b = base["phases"].get(name)
+            if b is None:
+                continue
+            new, old = s["median_ms"], b["median_ms"]
+            ratio = new / old if old else float("inf")
+            slower = new > old * (1 + threshold) and new - old > min_ms
+            regressions += slower
+            mark = "REGRESSION" if slower else ""
+            out.write(f"{key:32} {name:10} {old:10.3f} -> {new:10.3f} ms  x{ratio:5.2f} {mark}\n")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the PA1, PA2 and PA3 interpreters")
+    ap.add_argument("only", nargs="*", help="run only the programs whose key contains one of these")
+    ap.add_argument(
+        "--backend", default="rewrite",
+        help="PA3 backends: a comma-separated list, or all (default: rewrite)",
+    )
+    ap.add_argument("--warmup", type=int, default=WARMUP, help="untimed runs per program")
+    ap.add_argument("--repeat", type=int, default=REPEAT, help="timed runs per program")
+    ap.add_argument("--json", metavar="PATH", help="write the results as JSON (- for stdout)")
+    ap.add_argument("--compare", metavar="PATH", help="compare against results saved with --json")
+    ap.add_argument(
+        "--threshold", type=float, default=THRESHOLD,
+        help="slowdown of a median that counts as a regression (default: 0.10)",
+    )
+    ap.add_argument(
+        "--min-ms", type=float, default=MIN_MS,
+        help="smallest slowdown in ms that counts as a regression (default: 0.05)",
+    )
+    args = ap.parse_args()
+
+    if args.backend == "all":
+        sys.path.insert(0, PA3_DIR)
+        from interpreter import BACKENDS
+        backends = list(BACKENDS)
+    else:
+        backends = args.backend.split(",")
+
+    results = {}
+    log = sys.stderr if args.json == "-" else sys.stdout
+    for key, src, phases in benchmarks(backends):
+        if args.only and not any(s in key for s in args.only):
+            continue
+        log.write(f"{key} ...\n")
+        log.flush()
+        results[key] = measure(phases(), src, args.warmup, args.repeat)
+
+    print_results(results, log)
+
+    report = {
+        "environment": environment(),
+        "settings": {"warmup": args.warmup, "repeat": args.repeat},
+        "results": results,
+    }
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        log.write("\n")
+        regressions = compare(results, baseline, args.threshold, args.min_ms, log)
+        log.write(f"\n{regressions} regression(s)\n")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()